@@ -0,0 +1,84 @@
+"""Save/load throughput of saved histories: legacy JSON document vs JSON lines vs MessagePack logs
+
+Usage: python benchmarks/bench_history.py [--messages N] [--size CHARS] [--repeat R]
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+# Run from a checkout without installing the package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from duck_chat.models import Message, ModelType, Role, SavedHistory, models  # noqa: E402
+
+
+def make_messages(count: int, size: int) -> list[Message]:
+    text = ("lorem ipsum dolor sit amet, " * (size // 28 + 1))[:size]
+    return [Message(Role.user if i % 2 == 0 else Role.assistant, f"{i} {text}") for i in range(count)]
+
+
+def legacy_save(history: SavedHistory) -> None:
+    """What SavedHistory.save() did before the append-only log"""
+    with open(os.path.join(models.SAVE_DIR, f"history_{history.id}.json"), "w") as f:
+        json.dump(history.to_dict(), f, indent=4)
+
+
+def legacy_load(history_id: str) -> SavedHistory:
+    with open(os.path.join(models.SAVE_DIR, f"history_{history_id}.json")) as f:
+        data = json.load(f)
+    return SavedHistory(
+        model=ModelType(data["model"]),
+        messages=[Message(Role(m["role"]), m["content"]) for m in data["messages"]],
+        id=data["id"],
+    )
+
+
+def bench(name: str, messages: list[Message], repeat: int, save, load) -> None:
+    history = SavedHistory(model=ModelType.Claude)
+    # One save per turn, as the chat does
+    start = time.perf_counter()
+    for message in messages:
+        history.messages.append(message)
+        save(history)
+    save_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        loaded = load(history.id)
+    load_time = (time.perf_counter() - start) / repeat
+    assert loaded.messages == history.messages
+
+    size = sum(
+        os.path.getsize(os.path.join(models.SAVE_DIR, name))
+        for name in os.listdir(models.SAVE_DIR)
+        if name.startswith(f"history_{history.id}")
+    )
+    print(
+        f"{name:<10} save {len(messages) / save_time:>10.0f} turns/s   "
+        f"load {len(messages) / load_time:>12.0f} msgs/s   file {size / 1024:>8.1f} KiB"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=500, help="Messages per conversation")
+    parser.add_argument("--size", type=int, default=400, help="Characters per message")
+    parser.add_argument("--repeat", type=int, default=20, help="Loads to average")
+    args = parser.parse_args()
+
+    messages = make_messages(args.messages, args.size)
+    # Measure the files only, not the SQLite index
+    SavedHistory.index = None
+    with tempfile.TemporaryDirectory() as directory:
+        models.SAVE_DIR = directory
+        bench("legacy", messages, args.repeat, legacy_save, legacy_load)
+        for fmt in models.LOG_FORMATS:
+            SavedHistory.format = fmt
+            bench(fmt, messages, args.repeat, SavedHistory.save, SavedHistory.load)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""Cold start time of the CLI and of duck_chat.api, measured with python -X importtime
+
+Fails (exit status 1) when an import goes over its budget or pulls in a
+module that should only load on use.
+
+Usage: python benchmarks/bench_startup.py [--repeat R] [--api-budget MS] [--cli-budget MS]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+# Only imported when used: the GUI toolkit, Markdown rendering, the config file and the user agent data
+LAZY_MODULES = ("kivy", "rich", "toml", "fake_useragent")
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_time(module: str) -> tuple[float, list[str]]:
+    """Import time of module in ms, its parent packages included, and the lazy modules it loaded anyway"""
+    check = f"import sys; print(','.join(m for m in {LAZY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}; {check}"],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=ROOT,
+        env={**os.environ, "PYTHONDONTWRITEBYTECODE": "1"},
+    )
+    # Lines are "import time: self | cumulative | name", nested imports have their name indented.
+    # The package __init__ (duck_chat) counts too: it is either nested in the line of the module
+    # or reported on a top level line of its own before it, depending on the Python version.
+    parts = module.split(".")
+    names = {".".join(parts[:i]) for i in range(1, len(parts) + 1)}
+    total = 0
+    found = False
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if len(fields) == 3 and fields[2].strip() in names and not fields[2][1:].startswith(" "):
+            total += int(fields[1])
+            found = found or fields[2].strip() == module
+    if not found:
+        raise RuntimeError(f"No import time reported for {module}")
+    return total / 1000, [name for name in result.stdout.strip().split(",") if name]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per module, the fastest counts")
+    parser.add_argument("--api-budget", type=float, default=400, help="Budget of import duck_chat.api in ms")
+    parser.add_argument("--cli-budget", type=float, default=450, help="Budget of import duck_chat.cli in ms")
+    args = parser.parse_args()
+
+    failed = False
+    for module, budget in (("duck_chat.api", args.api_budget), ("duck_chat.cli", args.cli_budget)):
+        runs = [import_time(module) for _ in range(args.repeat)]
+        best = min(ms for ms, _ in runs)
+        loaded = runs[0][1]
+        status = "ok" if best <= budget and not loaded else "FAIL"
+        print(f"{module:<15} {best:>8.1f} ms   budget {budget:>6.0f} ms   {status}")
+        if loaded:
+            print(f"{'':<15} loaded at import: {', '.join(loaded)}")
+        failed = failed or status != "ok"
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
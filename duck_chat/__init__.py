@@ -1,5 +1,38 @@
 __version__ = "v1.3.3"
 from .api import DuckChat
+from .budget import Budget, CompactionStrategy, ContextBudget
+from .cache import ResponseCache
+from .chat_pool import DuckChatPool
+from .connection import ConnectionPool, get_default_pool
+from .metrics import REGISTRY, MetricsRegistry
 from .models import ModelType, SavedHistory
+from .persistence import HistoryWriter
+from .ratelimit import Priority, RateLimiter, get_default_limiter
+from .singleflight import SingleFlight
+from .tracing import TraceEvent, Tracer
+from .vqd import VqdPrefetcher
+from .worker import LoopThread
 
-__all__ = ["DuckChat", "ModelType", "SavedHistory"]
+__all__ = [
+    "Budget",
+    "CompactionStrategy",
+    "ConnectionPool",
+    "ContextBudget",
+    "DuckChat",
+    "DuckChatPool",
+    "HistoryWriter",
+    "LoopThread",
+    "MetricsRegistry",
+    "ModelType",
+    "Priority",
+    "REGISTRY",
+    "RateLimiter",
+    "ResponseCache",
+    "SavedHistory",
+    "SingleFlight",
+    "TraceEvent",
+    "Tracer",
+    "VqdPrefetcher",
+    "get_default_limiter",
+    "get_default_pool",
+]
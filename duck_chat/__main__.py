@@ -1,8 +1,8 @@
 import sys
 import asyncio
 import os
-from duck_chat.gui import ChatApp  # Absolute import
-from duck_chat.cli import CLI  # Absolute import
+
+# The interfaces are imported once chosen, the CLI never pays for loading Kivy
 
 def main():
     if getattr(sys, 'frozen', False) or is_android():  # Using getattr for safer checking
@@ -23,6 +23,8 @@ def launch_interface():
 
         if choice == "1":
             # Launch the CLI
+            from duck_chat.cli import CLI  # Absolute import
+
             asyncio.run(CLI().run())
             break
         elif choice == "2":
@@ -33,6 +35,8 @@ def launch_interface():
             print("Invalid choice. Please enter 1 or 2.")
 
 def launch_gui():
+    from duck_chat.gui import ChatApp  # Absolute import
+
     ChatApp().run()
 
 def is_android():
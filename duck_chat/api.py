@@ -1,55 +1,119 @@
+import asyncio
+import contextlib
+import functools
+import time
 from types import TracebackType
-from typing import AsyncGenerator, Self
+from typing import TYPE_CHECKING, Any, AsyncGenerator, Awaitable, Callable, Self, TypeVar
 
 import aiohttp
 import msgspec
-from fake_useragent import UserAgent
 
+from .budget import ContextBudget, summary_prompt
+from .cache import ResponseCache
+from .connection import ConnectionPool
 from .exceptions import (
     ConversationLimitException,
     DuckChatException,
     RatelimitException,
 )
-from .models import History, ModelType, Message, Role
+from .metrics import REGISTRY, MetricsRegistry
+from .models import History, Message, ModelType, Role
 from .models import SavedHistory
-import json
-import os
+from .ratelimit import Priority, RateLimiter, get_default_limiter
+from .sse import SSEParser, raise_for_event
+from .tracing import Tracer
 import logging
 from uuid import uuid4
 
+if TYPE_CHECKING:
+    from fake_useragent import UserAgent
+
+    from .persistence import HistoryWriter
+    from .singleflight import SingleFlight
+    from .vqd import VqdPrefetcher
+
+HEADERS = {
+    "Host": "duckduckgo.com",
+    "Accept": "text/event-stream",
+    "Accept-Language": "en-US,en;q=0.5",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Referer": "https://duckduckgo.com/",
+    "DNT": "1",
+    "Sec-GPC": "1",
+    "Connection": "keep-alive",
+    "Sec-Fetch-Dest": "empty",
+    "Sec-Fetch-Mode": "cors",
+    "Sec-Fetch-Site": "same-origin",
+    "TE": "trailers",
+}
+
+DEFAULT_BASE_URL = "https://duckduckgo.com"
+
+T = TypeVar("T")
+
+
+@functools.cache
+def default_user_agents() -> "UserAgent":
+    """Browser user agents to pick from, loaded on first use and shared by every DuckChat"""
+    from fake_useragent import UserAgent
+
+    return UserAgent(min_version=120.0)
+
+
 class DuckChat:
     
     def __init__(
         self,
         model: ModelType = ModelType.Claude,
         session: aiohttp.ClientSession | None = None,
-        user_agent: UserAgent | str = UserAgent(min_version=120.0),
+        user_agent: "UserAgent | str | None" = None,
+        pool: ConnectionPool | None = None,
+        rate_limiter: RateLimiter | None = None,
+        priority: Priority = Priority.interactive,
+        prefetcher: "VqdPrefetcher | None" = None,
+        tracer: Tracer | None = None,
+        metrics: MetricsRegistry = REGISTRY,
+        cache: ResponseCache | None = None,
+        writer: "HistoryWriter | None" = None,
+        singleflight: "SingleFlight | None" = None,
+        context_budget: ContextBudget | None = None,
+        base_url: str = DEFAULT_BASE_URL,
     ) -> None:
-        # Configuration de base du logging
-        logging.basicConfig(level=logging.DEBUG)
         self.logger = logging.getLogger(__name__)
+        # Another host serving the same API, e.g. the bundled MockChatServer
+        self.base_url = base_url.rstrip("/")
+        if user_agent is None:
+            user_agent = default_user_agents()
         if isinstance(user_agent, str):
             self.user_agent = user_agent
         else:
             self.user_agent = user_agent.random  # type: ignore
 
-        self._session = session or aiohttp.ClientSession(
-            headers={
-                "Host": "duckduckgo.com",
-                "Accept": "text/event-stream",
-                "Accept-Language": "en-US,en;q=0.5",
-                "Accept-Encoding": "gzip, deflate, br",
-                "Referer": "https://duckduckgo.com/",
-                "User-Agent": self.user_agent,
-                "DNT": "1",
-                "Sec-GPC": "1",
-                "Connection": "keep-alive",
-                "Sec-Fetch-Dest": "empty",
-                "Sec-Fetch-Mode": "cors",
-                "Sec-Fetch-Site": "same-origin",
-                "TE": "trailers",
-            }
-        )
+        # Connection level trace events need the tracer installed on the session,
+        # pass tracer.trace_config yourself when bringing your own session
+        self.tracer = tracer
+        self.metrics = metrics
+        self.cache = cache
+        self.writer = writer
+        self.singleflight = singleflight
+        self.context_budget = context_budget
+        # History bytes the last compactions took out, not sent again on every later turn
+        self.context_saved_bytes = 0
+        self._sent_at = 0.0
+        trace_configs = [tracer.trace_config] if tracer is not None else []
+        headers = {**HEADERS, "User-Agent": self.user_agent}
+        if self.base_url != DEFAULT_BASE_URL:
+            del headers["Host"]  # let aiohttp send the host of base_url
+        if session is not None:
+            self._session = session
+        elif pool is not None:
+            # Share sockets and DNS cache with every other chat on the same pool
+            self._session = pool.session(headers=headers, trace_configs=trace_configs)
+        else:
+            self._session = aiohttp.ClientSession(headers=headers, trace_configs=trace_configs)
+        self.rate_limiter = rate_limiter or get_default_limiter()
+        self.priority = priority
+        self.prefetcher = prefetcher
         self.vqd: list[str] = []
         self.history = History(model=model, messages=[])  # Historique de la conversation actuelle
         self.saved_history = SavedHistory(model=self.history.model)  # Initialisation unique
@@ -68,10 +132,50 @@ class DuckChat:
     ) -> None:
         await self._session.__aexit__(exc_type, exc_value, traceback)
 
+    async def _throttled(self, request: Callable[[], Awaitable[T]]) -> T:
+        """Run request through the rate limiter, retrying rate limited attempts with backoff"""
+        limiter = self.rate_limiter
+        attempt = 0
+        while True:
+            await limiter.acquire(self.priority)
+            try:
+                result = await request()
+            except ConversationLimitException:
+                limiter.on_throttle()
+                self.metrics.inc("conversation_limit", self.history.model.name)
+                raise
+            except RatelimitException:
+                limiter.on_throttle()
+                self.metrics.inc("ratelimit", self.history.model.name)
+                if attempt >= limiter.retries:
+                    raise
+                delay = limiter.backoff(attempt)
+                self.logger.warning("Rate limited, retrying in %.1fs", delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+            else:
+                limiter.on_success()
+                return result
+
     async def get_vqd(self) -> None:
         """Get new x-vqd-4 token"""
+        tracer = self.tracer
+        if tracer:
+            tracer.emit("vqd_fetch_start")
+        if self.prefetcher is not None:
+            token = self.prefetcher.take()
+            if token is not None:
+                self.vqd.append(token)
+                if tracer:
+                    tracer.emit("vqd_fetch_end", prefetched=True)
+                return
+        await self._throttled(self._fetch_vqd)
+        if tracer:
+            tracer.emit("vqd_fetch_end", prefetched=False)
+
+    async def _fetch_vqd(self) -> None:
         async with self._session.get(
-            "https://duckduckgo.com/duckchat/v1/status", headers={"x-vqd-accept": "1"}
+            f"{self.base_url}/duckchat/v1/status", headers={"x-vqd-accept": "1"}
         ) as response:
             if response.status == 429:
                 res = await response.read()
@@ -86,64 +190,87 @@ class DuckChat:
             else:
                 raise DuckChatException("No x-vqd-4")
 
+    async def _encode_history(self) -> bytes:
+        """The /chat payload of the history, compacted first when it is over the context budget"""
+        budget = self.context_budget
+        if budget is not None:
+            compaction = await budget.compact(self.history, self._summarize)
+            if compaction is not None:
+                self.context_saved_bytes += compaction.saved
+                self.metrics.inc("compactions", self.history.model.name)
+                self.logger.info(
+                    "History compacted (%s): %d messages, %d bytes left out",
+                    compaction.strategy.value,
+                    compaction.dropped,
+                    compaction.saved,
+                )
+                # Keep one token per question for reask_question
+                questions = sum(message.role is Role.user for message in self.history.messages)
+                del self.vqd[:max(len(self.vqd) - questions, 0)]
+            if self.context_saved_bytes:
+                self.metrics.observe("context_saved_bytes", self.history.model.name, self.context_saved_bytes)
+        return self.__encoder.encode(self.history)
+
+    async def _summarize(self, messages: list[Message]) -> str:
+        """Summary of messages written by the model, asked in a conversation of its own"""
+        history = History(model=self.history.model, messages=[Message(Role.user, summary_prompt(messages))])
+        payload = self.__encoder.encode(history)
+        summary = await self._throttled(lambda: self._fetch_answer(payload))
+        self._reuse_vqd(self.vqd.pop())
+        return summary
+
+    def _reuse_vqd(self, token: str | None = None) -> None:
+        """Keep the token of a turn that sent no /chat request of its own for the next one
+
+        After a cache hit or a coalesced answer the current token is still
+        unused. A summary request used it up, ``token``, the one it got
+        back, takes its place.
+        """
+        if token is not None:
+            self.vqd[-1] = token
+        else:
+            self.vqd.append(self.vqd[-1])
+
     async def get_answer(self) -> str:
         """Get message answer from chatbot"""
+        payload = await self._encode_history()
+        key = ""
+        if self.cache is not None:
+            key = self.cache.key(payload)
+            chunks = await self.cache.get(key, len(payload))
+            if chunks is not None:
+                self._reuse_vqd()
+                return "".join(chunks)
+        if self.singleflight is not None:
+            message = "".join([chunk async for chunk in self._coalesced(payload)])
+        else:
+            message = await self._throttled(lambda: self._fetch_answer(payload))
+        if self.cache is not None:
+            self.cache.put(key, [message])
+        return message
+
+    async def _fetch_answer(self, payload: bytes) -> str:
         # Log the request data before sending
-        self.logger.debug(f"Sending request with history: {self.history}")
+        self.logger.debug("Sending request with history: %s", self.history)
 
-        async with self._session.post(
-            "https://duckduckgo.com/duckchat/v1/chat",
-            headers={
-                "Content-Type": "application/json",
-                "x-vqd-4": self.vqd[-1],
-            },
-            data=self.__encoder.encode(self.history),
-        ) as response:
+        response = await self._post_chat(payload)
+        async with response:
             # Log the status code of the response
-            self.logger.debug(f"Response status: {response.status}")
-            
-            res = await response.read()
-            
-            # Log the raw response content
-            self.logger.debug(f"Raw response content: {res.decode()}")
-            
-            if response.status == 429:
-                self.logger.error("Rate limit exceeded")
-                raise RatelimitException(res.decode())
-            
-            try:
-                data = self.__decoder.decode(
-                    b"["
-                    + b",".join(
-                        res.lstrip(b"data: ").rstrip(b"\n\ndata: [DONE][LIMIT_CONVERSATION]\n").split(b"\n\ndata: ")
-                    )
-                    + b"]"
-                )
-            except Exception as e:
-                self.logger.error(f"Failed to decode response: {str(e)}")
-                raise DuckChatException(f"Couldn't parse body={res.decode()}")
-            
+            self.logger.debug("Response status: %s", response.status)
+
             message = []
-            for x in data:
-                if x.get("action") == "error":
-                    err_message = x.get("type", "") or str(x)
-                    if x.get("status") == 429:
-                        if err_message == "ERR_CONVERSATION_LIMIT":
-                            self.logger.error("Conversation limit reached")
-                            raise ConversationLimitException(err_message)
-                        self.logger.error("Rate limit error in action error")
-                        raise RatelimitException(err_message)
-                    self.logger.error(f"Error in response action: {err_message}")
-                    raise DuckChatException(err_message)
+            async for x in self._read_events(response):
                 message.append(x.get("message", ""))
-        
+
         # Log the final message before returning
         final_message = "".join(message)
-        self.logger.debug(f"Final message: {final_message}")
+        self.logger.debug("Final message: %s", final_message)
+        if self.tracer:
+            self.tracer.emit("complete", chars=len(final_message))
 
-        self.vqd.append(response.headers.get("x-vqd-4", ""))
+        self._next_vqd(response)
         return final_message
-    
+
     async def ask_question(self, query: str) -> str:
         if not self.vqd:
             await self.get_vqd()
@@ -155,15 +282,21 @@ class DuckChat:
         message = await self.get_answer()
 
         self.history.add_answer(message)
-        
+        self._record_turn(query, message)
+
+        return message
+
+    def _record_turn(self, query: str, message: str) -> None:
+        """Add a finished question and answer to the saved history and save it"""
         # Ajouter la question et la réponse à l'historique sauvegardé
         self.saved_history.add_input(query)
         self.saved_history.add_answer(message)
-        
-        # Sauvegarder automatiquement après chaque interaction
-        self.saved_history.save()
 
-        return message
+        # Sauvegarder automatiquement après chaque interaction
+        if self.writer is not None:
+            self.writer.mark_dirty(self.saved_history)
+        else:
+            self.saved_history.save()
 
     async def reask_question(self, num: int) -> str:
         """Get re-answer from chat AI"""
@@ -188,31 +321,142 @@ class DuckChat:
 
     async def stream_answer(self) -> AsyncGenerator[str, None]:
         """Stream answer from chatbot"""
-        async with self._session.post(
-            "https://duckduckgo.com/duckchat/v1/chat",
+        payload = await self._encode_history()
+        cache = self.cache
+        key = ""
+        if cache is not None:
+            key = cache.key(payload)
+            chunks = await cache.get(key, len(payload))
+            if chunks is not None:
+                for chunk in chunks:
+                    yield chunk
+                self._reuse_vqd()
+                return
+
+        received = []
+        chunks = self._coalesced(payload) if self.singleflight is not None else self._stream_chat(payload)
+        async with contextlib.aclosing(chunks):
+            async for chunk in chunks:
+                if cache is not None:
+                    received.append(chunk)
+                yield chunk
+        if cache is not None:
+            cache.put(key, received)
+
+    async def _coalesced(self, payload: bytes) -> AsyncGenerator[str, None]:
+        """Stream the answer to payload, over the request of an identical one in flight if any"""
+        assert self.singleflight is not None
+        flight, leader = self.singleflight.join(payload, lambda: self._stream_chat(payload))
+        if not leader:
+            self.metrics.inc("coalesced", self.history.model.name)
+        async with contextlib.aclosing(flight.subscribe()) as chunks:
+            async for chunk in chunks:
+                yield chunk
+        if not leader:
+            self._reuse_vqd()
+
+    async def _stream_chat(self, payload: bytes) -> AsyncGenerator[str, None]:
+        """Send payload to /chat and stream the answer"""
+        response = await self._throttled(lambda: self._post_chat(payload))
+        chars = 0
+        async with response:
+            try:
+                async for data in self._read_events(response):
+                    if data.get("message"):
+                        chars += len(data["message"])
+                        yield data["message"]
+            except ConversationLimitException:
+                self.rate_limiter.on_throttle()
+                self.metrics.inc("conversation_limit", self.history.model.name)
+                raise
+            except RatelimitException:
+                self.rate_limiter.on_throttle()
+                self.metrics.inc("ratelimit", self.history.model.name)
+                raise
+            except DuckChatException:
+                raise
+            except Exception as e:
+                raise DuckChatException(f"Error while streaming data: {str(e)}")
+        if self.tracer:
+            self.tracer.emit("complete", chars=chars)
+        self._next_vqd(response)
+
+    async def _read_events(self, response: aiohttp.ClientResponse) -> AsyncGenerator[dict[str, Any], None]:
+        """Parse the SSE body of a /chat response into events"""
+        parser = SSEParser(self.__decoder)
+        tracer = self.tracer
+        first_token_at: float | None = None
+        tokens = chars = 0
+
+        async def batches() -> AsyncGenerator[list[dict[str, Any]], None]:
+            async for chunk in response.content.iter_any():
+                if tracer:
+                    if not parser.size:
+                        tracer.emit("first_byte")
+                    tracer.emit("chunk", size=len(chunk))
+                yield parser.feed(chunk)
+            yield parser.close()
+
+        async for events in batches():
+            for event in events:
+                message = event.get("message")
+                if message:
+                    if first_token_at is None:
+                        first_token_at = time.perf_counter()
+                        if tracer:
+                            tracer.emit("first_token")
+                    tokens += 1
+                    chars += len(message)
+                yield event
+
+        self.metrics.record_turn(
+            self.history.model.name,
+            latency=time.perf_counter() - self._sent_at,
+            ttft=first_token_at - self._sent_at if first_token_at is not None else None,
+            tokens=tokens,
+            chars=chars,
+        )
+
+    async def _post_chat(self, payload: bytes) -> aiohttp.ClientResponse:
+        """Send the encoded history to /chat, return the response once its status is checked"""
+        self.metrics.observe("request_bytes", self.history.model.name, len(payload))
+        # A DuckChat runs one turn at a time, the read loop measures latency from here
+        self._sent_at = time.perf_counter()
+        response = await self._session.post(
+            f"{self.base_url}/duckchat/v1/chat",
             headers={
                 "Content-Type": "application/json",
                 "x-vqd-4": self.vqd[-1],
             },
-            data=self.__encoder.encode(self.history),
-        ) as response:
-            if response.status == 429:
-                raise RatelimitException(await response.text())
+            data=payload,
+        )
+        if response.status == 429:
+            async with response:
+                res = await response.text()
+            if "ERR_CONVERSATION_LIMIT" in res:
+                self.logger.error("Conversation limit reached")
+                raise ConversationLimitException(res)
+            self.logger.error("Rate limit exceeded")
+            raise RatelimitException(res)
+        if not 200 <= response.status < 300:
+            async with response:
+                res = await response.read()
             try:
-                async for line in response.content:
-                    if line.startswith(b"data: "):
-                        chunk = line[6:]
-                        if chunk.startswith(b"[DONE]"):
-                            break
-                        try:
-                            data = self.__decoder.decode(chunk)
-                            if "message" in data and data["message"]:
-                                yield data["message"]
-                        except Exception:
-                            raise DuckChatException(f"Couldn't parse body={chunk.decode()}")
-            except Exception as e:
-                raise DuckChatException(f"Error while streaming data: {str(e)}")
-        self.vqd.append(response.headers.get("x-vqd-4", ""))
+                event = self.__decoder.decode(res)
+            except msgspec.DecodeError:
+                event = None
+            if isinstance(event, dict):
+                raise_for_event(event)
+            self.logger.error("Unexpected status %s", response.status)
+            raise DuckChatException(f"Couldn't parse body={res.decode(errors='replace')}")
+        return response
+
+    def _next_vqd(self, response: aiohttp.ClientResponse) -> None:
+        """Keep the x-vqd-4 token of a /chat answer for the next turn"""
+        token = response.headers.get("x-vqd-4")
+        if not token:
+            raise DuckChatException("No x-vqd-4")
+        self.vqd.append(token)
 
     async def ask_question_stream(self, query: str) -> AsyncGenerator[str, None]:
         """Stream answer from chat AI"""
@@ -225,7 +469,9 @@ class DuckChat:
             yield message
             message_list.append(message)
 
-        self.history.add_answer("".join(message_list))
+        answer = "".join(message_list)
+        self.history.add_answer(answer)
+        self._record_turn(query, answer)
 
     async def reask_question_stream(self, num: int) -> AsyncGenerator[str, None]:
         """Stream re-answer from chat AI"""
@@ -261,22 +507,17 @@ class DuckChat:
     @staticmethod
     def load_history(history_id: str) -> History:
         """Load a conversation history from a file."""
-        file_path = f"history_{history_id}.json"
-        if not os.path.exists(file_path):
-            raise DuckChatException(f"No history found for ID {history_id}")
-        
-        with open(file_path, 'r') as f:
-            history_data = json.load(f)
-        
-        return History(
-            model=ModelType(history_data['model']),
-            messages=[Message(Role(msg['role']), msg['content']) for msg in history_data['messages']]
-        )
-        
+        saved_history = SavedHistory.load(history_id)
+        return History(model=saved_history.model, messages=saved_history.messages)
+
     async def close_session(self):
         """Close the session and save the final history."""
         # Sauvegarde finale de l'historique avant de fermer la session
-        self.saved_history.save()
+        if self.writer is not None:
+            self.writer.mark_dirty(self.saved_history)
+            await self.writer.flush()
+        else:
+            self.saved_history.save()
         
         if self._session is not None:
             await self._session.close()
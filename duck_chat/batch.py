@@ -0,0 +1,338 @@
+import asyncio
+import contextlib
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Iterator
+
+import aiohttp
+import msgspec
+
+try:
+    import uvloop
+except ImportError:  # optional, workers run the default event loop
+    uvloop = None
+
+from .chat_pool import DuckChatPool
+from .connection import ConnectionPool
+from .exceptions import DuckChatException
+from .metrics import REGISTRY
+from .models import ModelType
+from .models.models import scratch_histories
+from .ratelimit import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+class BatchItem(msgspec.Struct):
+    """One input record: an independent conversation of one or more prompts"""
+    id: str | int | None = None  # line number when missing
+    prompt: str | None = None
+    prompts: list[str] = []
+    model: str | None = None  # ModelType name, the batch model when missing
+
+
+class BatchResult(msgspec.Struct, omit_defaults=True):
+    """One output record, latency in seconds"""
+    id: str
+    line: int  # of the input
+    model: str
+    answers: list[str]
+    latency: float
+    error: str | None = None
+    error_type: str | None = None
+
+
+class CheckpointEntry(msgspec.Struct, array_like=True):
+    id: str
+    ok: bool
+    end: int  # size of the output once the result was written
+
+
+class BatchStats(msgspec.Struct):
+    done: int = 0
+    failed: int = 0
+    skipped: int = 0  # completed by a previous run
+
+    def add(self, other: 'BatchStats') -> None:
+        self.done += other.done
+        self.failed += other.failed
+        self.skipped += other.skipped
+
+
+class Checkpoint:
+    """Ids completed by previous runs of a batch
+
+    Every result appends one entry with the output size after it was
+    written. On resume the output is truncated to the last checkpointed
+    size, so a result written right before a kill is redone instead of
+    duplicated.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.entries: dict[str, CheckpointEntry] = {}
+        self.end = 0
+        self._encoder = msgspec.json.Encoder()
+        self._file = None
+
+    def load(self) -> None:
+        decoder = msgspec.json.Decoder(CheckpointEntry)
+        try:
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    try:
+                        entry = decoder.decode(line)
+                    except msgspec.DecodeError:
+                        break  # torn last write
+                    self.entries[entry.id] = entry
+                    self.end = max(self.end, entry.end)
+        except FileNotFoundError:
+            pass
+
+    def open(self, resume: bool) -> None:
+        self._file = open(self.path, 'ab' if resume else 'wb')
+
+    def record(self, entry: CheckpointEntry) -> None:
+        self.entries[entry.id] = entry
+        self._file.write(self._encoder.encode(entry) + b"\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def read_items(path: str, shard: tuple[int, int] = (0, 1)) -> Iterator[tuple[int, str, BatchItem]]:
+    """(line number, id, item) of the input lines of shard (index, count), read lazily"""
+    decoder = msgspec.json.Decoder(BatchItem)
+    index, count = shard
+    with open(path, 'rb') as f:
+        for number, line in enumerate(f, 1):
+            if number % count != index or not line.strip():
+                continue
+            try:
+                item = decoder.decode(line)
+            except msgspec.DecodeError as e:
+                raise ValueError(f"{path}:{number}: {e}") from None
+            if item.prompt is not None:
+                item.prompts = [item.prompt, *item.prompts]
+            yield number, str(item.id if item.id is not None else number), item
+
+
+async def run_batch(
+    input_path: str,
+    output_path: str,
+    concurrency: int = 8,
+    model: ModelType = ModelType.Claude,
+    checkpoint_path: str | None = None,
+    resume: bool = True,
+    retry_errors: bool = False,
+    save_histories: bool = False,
+    shard: tuple[int, int] = (0, 1),
+    **chat_kwargs: Any,
+) -> BatchStats:
+    """Answer every conversation of ``input_path``, appending results to ``output_path`` as they finish
+
+    Input lines are ``{"id": ..., "prompt": "..."}`` or ``{"id": ...,
+    "prompts": ["...", ...]}``, with an optional ``"model"``. Output lines
+    are BatchResult records in completion order. With ``resume``, ids done
+    according to the checkpoint (``<output>.ckpt`` by default) are skipped,
+    failed ones too unless ``retry_errors``; the last line of an id wins.
+    Results are flushed as they are written, so they survive the process
+    being killed. Conversations are not saved to the history directory
+    unless ``save_histories``. ``shard`` (index, count) only runs the
+    input lines whose number modulo count is index.
+    """
+    checkpoint = Checkpoint(checkpoint_path or f"{output_path}.ckpt")
+    if resume:
+        checkpoint.load()
+        size = os.path.getsize(output_path) if os.path.exists(output_path) else 0
+        if size < checkpoint.end:
+            logger.warning("Output %s is missing results of %s, starting over", output_path, checkpoint.path)
+            checkpoint = Checkpoint(checkpoint.path)
+            resume = False
+    stats = BatchStats()
+    encoder = msgspec.json.Encoder()
+
+    output = open(output_path, 'r+b' if resume and os.path.exists(output_path) else 'wb')
+    checkpoint.open(resume)
+    items = read_items(input_path, shard)
+
+    async def worker(pool: DuckChatPool) -> None:
+        # Pulling from one shared iterator keeps at most ``concurrency`` conversations in memory
+        for line, item_id, item in items:
+            done = checkpoint.entries.get(item_id)
+            if done is not None and (done.ok or not retry_errors):
+                stats.skipped += 1
+                continue
+            result = await answer(pool, line, item_id, item)
+            output.write(encoder.encode(result) + b"\n")
+            output.flush()
+            checkpoint.record(CheckpointEntry(item_id, result.error is None, output.tell()))
+            if result.error is None:
+                stats.done += 1
+            else:
+                stats.failed += 1
+
+    try:
+        # Drop results written after the last checkpoint entry, they are redone
+        output.truncate(checkpoint.end)
+        output.seek(checkpoint.end)
+        with contextlib.nullcontext() if save_histories else scratch_histories():
+            async with ConnectionPool(limit=concurrency) as connections, DuckChatPool(
+                model=model, concurrency=concurrency, pool=connections, **chat_kwargs
+            ) as pool:
+                await asyncio.gather(*(worker(pool) for _ in range(concurrency)))
+    finally:
+        output.close()
+        checkpoint.close()
+    logger.info("Batch done: %d answered, %d failed, %d skipped", stats.done, stats.failed, stats.skipped)
+    return stats
+
+
+async def answer(pool: DuckChatPool, line: int, item_id: str, item: BatchItem) -> BatchResult:
+    """Run the prompts of one conversation, errors end up in the result"""
+    model = ModelType.__members__.get(item.model) if item.model else pool.model
+    if model is None:
+        return BatchResult(item_id, line, item.model, [], 0.0, f"Unknown model {item.model}", "ValueError")
+    if not item.prompts:
+        return BatchResult(item_id, line, model.name, [], 0.0, "No prompt", "ValueError")
+    pool.conversation(item_id, model)
+    answers: list[str] = []
+    start = time.perf_counter()
+    try:
+        for prompt in item.prompts:
+            answers.append(await pool.submit(item_id, prompt))
+    except (DuckChatException, aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return BatchResult(
+            item_id, line, model.name, answers, time.perf_counter() - start, str(e) or repr(e), type(e).__name__
+        )
+    finally:
+        await pool.close(item_id)
+    return BatchResult(item_id, line, model.name, answers, time.perf_counter() - start)
+
+
+def run_sharded_batch(
+    input_path: str,
+    output_path: str,
+    processes: int | None = None,
+    concurrency: int = 8,
+    rate: float | None = None,
+    model: ModelType = ModelType.Claude,
+    resume: bool = True,
+    retry_errors: bool = False,
+    **chat_kwargs: Any,
+) -> BatchStats:
+    """run_batch() split over worker processes, for batches one event loop cannot parse fast enough
+
+    Input lines are dealt round-robin to ``processes`` workers (one per
+    core by default). Each runs its shard on its own event loop (uvloop
+    when installed) and connection pool, with its share of the
+    ``concurrency`` and ``rate`` budgets, into ``<output>.shard<i>of<n>``
+    with its own checkpoint. Once every shard is done they are merged into
+    ``output_path`` in input order, and their metrics into REGISTRY.
+    Resuming needs the same number of processes, shard files can be
+    deleted once the batch is complete.
+
+    ``chat_kwargs`` are sent to the workers, so they must be picklable.
+    """
+    processes = processes or os.cpu_count() or 1
+    shard_paths = [f"{output_path}.shard{index}of{processes}" for index in range(processes)]
+    stats = BatchStats()
+    # spawn: the workers do not inherit the state of this process (threads, event loop)
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+        futures = [
+            executor.submit(
+                _run_shard,
+                input_path,
+                shard_paths[index],
+                (index, processes),
+                concurrency // processes + (index < concurrency % processes) or 1,
+                rate,
+                processes,
+                model,
+                resume,
+                retry_errors,
+                chat_kwargs,
+            )
+            for index in range(processes)
+        ]
+        for future in futures:
+            shard_stats, metrics = future.result()
+            stats.add(shard_stats)
+            REGISTRY.merge(metrics)
+    merge_outputs(shard_paths, output_path)
+    logger.info("Batch done: %d answered, %d failed, %d skipped", stats.done, stats.failed, stats.skipped)
+    return stats
+
+
+def merge_outputs(paths: list[str], output_path: str) -> None:
+    """Write the results of every shard to output_path in input order, the last result of an id wins"""
+    decoder = msgspec.json.Decoder(BatchResult)
+    # Only positions are kept in memory, results are copied from the shard files
+    latest: dict[str, tuple[int, int, int, int]] = {}  # id -> line, shard, offset, length
+    for shard, path in enumerate(paths):
+        with open(path, 'rb') as f:
+            offset = 0
+            for data in f:
+                result = decoder.decode(data)
+                latest[result.id] = (result.line, shard, offset, len(data))
+                offset += len(data)
+    files = [open(path, 'rb') for path in paths]
+    try:
+        with open(f"{output_path}.tmp", 'wb') as output:
+            for _, shard, offset, length in sorted(latest.values()):
+                files[shard].seek(offset)
+                output.write(files[shard].read(length))
+        os.replace(f"{output_path}.tmp", output_path)
+    finally:
+        for f in files:
+            f.close()
+
+
+def shard_limiter(rate: float | None, shards: int = 1) -> RateLimiter:
+    """One shard's part of the rate budget of a whole batch
+
+    ``rate`` requests/s is both the starting rate and the cap, None splits
+    the defaults of RateLimiter.
+    """
+    default = RateLimiter()
+    return RateLimiter(
+        rate=(rate or default.rate) / shards,
+        burst=max(default.burst // shards, 1),
+        min_rate=min(default.min_rate, rate or default.min_rate) / shards,
+        max_rate=(rate or default.max_rate) / shards,
+    )
+
+
+def _run_shard(
+    input_path: str,
+    output_path: str,
+    shard: tuple[int, int],
+    concurrency: int,
+    rate: float | None,
+    shards: int,
+    model: ModelType,
+    resume: bool,
+    retry_errors: bool,
+    chat_kwargs: dict[str, Any],
+) -> tuple[BatchStats, dict[str, Any]]:
+    """Worker process entry point, returns its stats and metrics"""
+    coro = run_batch(
+        input_path,
+        output_path,
+        concurrency=concurrency,
+        model=model,
+        resume=resume,
+        retry_errors=retry_errors,
+        shard=shard,
+        rate_limiter=shard_limiter(rate, shards),
+        **chat_kwargs,
+    )
+    stats = uvloop.run(coro) if uvloop is not None else asyncio.run(coro)
+    return stats, REGISTRY.snapshot()
@@ -0,0 +1,176 @@
+import functools
+import logging
+from enum import Enum
+from typing import Awaitable, Callable
+
+import msgspec
+
+from .exceptions import DuckChatException
+from .models import History, Message, ModelType, Role
+
+logger = logging.getLogger(__name__)
+
+# JSON around one message: {"role":"assistant","content":""},
+MESSAGE_OVERHEAD_BYTES = 36
+MESSAGE_OVERHEAD_TOKENS = 4
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below in a few short paragraphs. Keep every fact, name, number, "
+    "decision and open question needed to continue it, and nothing else.\n\n"
+)
+SUMMARY_PREFIX = "Summary of our conversation so far:\n\n"
+SUMMARY_ACK = "Understood, I will continue from this summary."
+
+
+class CompactionStrategy(Enum):
+    drop_oldest = "drop_oldest"  # forget the oldest turns
+    keep_first = "keep_first"  # keep the first turn, which often sets the task, and the most recent ones
+    summarize = "summarize"  # replace the oldest turns by a summary written by the model
+
+
+class Budget(msgspec.Struct, frozen=True):
+    """Size the history sent to /chat should stay within"""
+    tokens: int
+    bytes: int
+
+
+# Well below the context windows of the models: the chat API refuses long conversations
+# (ERR_CONVERSATION_LIMIT) and the latency of every turn grows with the history sent
+DEFAULT_BUDGETS = {
+    ModelType.GPT4o: Budget(tokens=16000, bytes=64000),
+    ModelType.Claude: Budget(tokens=16000, bytes=64000),
+    ModelType.Llama: Budget(tokens=16000, bytes=64000),
+    ModelType.Mixtral: Budget(tokens=8000, bytes=32000),
+}
+
+
+class Compaction(msgspec.Struct):
+    """One compaction of a history, sizes of the encoded history in bytes"""
+    strategy: CompactionStrategy
+    dropped: int  # messages left out, a summary turn replaces them with ``summarize``
+    bytes_before: int
+    bytes_after: int
+
+    @property
+    def saved(self) -> int:
+        return self.bytes_before - self.bytes_after
+
+
+@functools.lru_cache(maxsize=4096)
+def estimate(content: str) -> tuple[int, int]:
+    """(tokens, bytes) of a message with this content in the /chat payload
+
+    About 4 bytes per token, close enough for the models served and much
+    cheaper than a tokenizer. Cached by content: str caches its hash, so a
+    message already seen costs a dictionary lookup on the next turns.
+    """
+    size = len(content.encode())
+    return (size + 3) // 4 + MESSAGE_OVERHEAD_TOKENS, size + MESSAGE_OVERHEAD_BYTES
+
+
+def summary_prompt(messages: list[Message]) -> str:
+    """Request to the model for a summary of messages"""
+    transcript = "\n\n".join(f"{message.role.value.upper()}: {message.content}" for message in messages)
+    return SUMMARY_PROMPT + transcript
+
+
+class ContextBudget:
+    """Keeps the history sent to /chat within a token and byte budget per model
+
+    Before every turn the history is measured with the cached estimates of
+    its messages. Over budget, whole turns (a question and its answer) are
+    taken out according to ``strategy`` until it fits, the question being
+    asked is always kept. ``summarize`` replaces them with a summary turn
+    asked to the model, sized to leave ``summary_share`` of the budget for
+    it, and falls back to ``drop_oldest`` when that request fails.
+
+    The history is compacted in place: later turns send the shorter
+    history too. One ContextBudget can be shared by many DuckChat.
+    """
+
+    def __init__(
+        self,
+        strategy: CompactionStrategy = CompactionStrategy.drop_oldest,
+        budgets: dict[ModelType, Budget] | None = None,
+        summary_share: float = 0.25,
+    ) -> None:
+        self.strategy = strategy
+        self.budgets = {**DEFAULT_BUDGETS, **(budgets or {})}
+        self.summary_share = summary_share
+
+        self.compactions = 0
+        self.summaries = 0
+        self.bytes_saved = 0  # by compactions, later turns sending the shorter history save it again
+
+        self._encoder = msgspec.json.Encoder()
+
+    def size(self, messages: list[Message]) -> tuple[int, int]:
+        """Estimated (tokens, bytes) of messages"""
+        tokens = size = 0
+        for message in messages:
+            t, b = estimate(message.content)
+            tokens += t
+            size += b
+        return tokens, size
+
+    def fits(self, model: ModelType, messages: list[Message], share: float = 1.0) -> bool:
+        return self._within(model, *self.size(messages), share)
+
+    def _within(self, model: ModelType, tokens: int, size: int, share: float = 1.0) -> bool:
+        budget = self.budgets[model]
+        return tokens <= budget.tokens * share and size <= budget.bytes * share
+
+    def plan(self, model: ModelType, messages: list[Message], share: float = 1.0) -> tuple[int, int]:
+        """Slice (start, stop) of the messages to leave out for the rest to fit ``share`` of the budget
+
+        Only whole turns are left out, as many as possible when even the
+        question being asked alone does not fit.
+        """
+        # Completed turns come in (question, answer) pairs before the question being asked
+        last = (len(messages) - 1) // 2 * 2
+        start = 2 if self.strategy is CompactionStrategy.keep_first and last > 2 else 0
+        tokens, size = self.size(messages)
+        stop = start
+        while stop < last and not self._within(model, tokens, size, share):
+            for message in messages[stop:stop + 2]:
+                t, b = estimate(message.content)
+                tokens -= t
+                size -= b
+            stop += 2
+        return start, stop
+
+    async def compact(
+        self, history: History, summarize: Callable[[list[Message]], Awaitable[str]]
+    ) -> Compaction | None:
+        """Compact history in place if it is over budget, summarize(messages) writes a summary"""
+        model = history.model
+        original = history.messages
+        if self.fits(model, original):
+            return None
+        bytes_before = len(self._encoder.encode(history))
+        messages = original
+        if self.strategy is CompactionStrategy.summarize:
+            start, stop = self.plan(model, messages, 1.0 - self.summary_share)
+            summary = None
+            if stop > start:
+                try:
+                    summary = await summarize(messages[start:stop])
+                except DuckChatException as e:
+                    logger.warning("Could not summarize the history, dropping the oldest turns: %s", e)
+            if summary is not None:
+                messages = [Message(Role.user, SUMMARY_PREFIX + summary), Message(Role.assistant, SUMMARY_ACK)]
+                messages += original[stop:]
+                self.summaries += 1
+        # Whatever is still over budget, a summary too long included
+        if not self.fits(model, messages):
+            start, stop = self.plan(model, messages)
+            messages = messages[:start] + messages[stop:]
+        kept = {id(message) for message in messages}
+        dropped = sum(id(message) not in kept for message in original)
+        if not dropped:
+            return None  # only the question being asked is left
+        history.messages = messages
+        compaction = Compaction(self.strategy, dropped, bytes_before, len(self._encoder.encode(history)))
+        self.compactions += 1
+        self.bytes_saved += compaction.saved
+        return compaction
@@ -0,0 +1,196 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Self
+
+import msgspec
+
+logger = logging.getLogger(__name__)
+
+
+class CacheEntry(msgspec.Struct):
+    created: float
+    chunks: list[str]
+
+    @property
+    def size(self) -> int:
+        return sum(len(chunk.encode()) for chunk in self.chunks)
+
+
+class ResponseCache:
+    """Exact-match answer cache: memory LRU in front of a size-capped disk tier
+
+    Answers are keyed by a hash of the encoded /chat payload, which holds the
+    model and the full history. Streamed answers are stored chunk by chunk so
+    a hit can be replayed through ``stream_answer`` as well.
+
+    Only the memory tier is used on the event loop. Files are read, written
+    and removed by a single background thread, so a slow disk delays the
+    lookups that miss in memory but never the other conversations, and
+    ``put()`` returns without waiting for the write.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 256,
+        directory: str | None = None,
+        max_disk_bytes: int = 64 * 1024 * 1024,
+        ttl: float | None = 24 * 3600,
+    ) -> None:
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0  # request and answer bytes not sent over the network
+
+        self._memory: OrderedDict[str, CacheEntry] = OrderedDict()
+        self._disk: OrderedDict[str, int] | None = None  # key -> file size, oldest first
+        self._disk_bytes = 0
+        self._encoder = msgspec.json.Encoder()
+        self._decoder = msgspec.json.Decoder(CacheEntry)
+        # Owns the disk index and the files, one thread keeps reads and writes of a key in order
+        self._executor = (
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix="duck_chat-cache") if directory is not None else None
+        )
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.close()
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    @staticmethod
+    def key(payload: bytes) -> str:
+        return hashlib.sha256(payload).hexdigest()
+
+    async def get(self, key: str, request_bytes: int = 0) -> list[str] | None:
+        """Cached answer chunks for key, None on a miss"""
+        entry = self._memory.get(key)
+        if entry is not None:
+            self._memory.move_to_end(key)
+        elif self._executor is not None:
+            entry = await asyncio.get_running_loop().run_in_executor(self._executor, self._read, key)
+            if entry is not None:
+                self._remember(key, entry)
+
+        if entry is not None and self.ttl is not None and time.time() - entry.created > self.ttl:
+            self._forget(key)
+            entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.bytes_saved += request_bytes + entry.size
+        return entry.chunks
+
+    def put(self, key: str, chunks: list[str]) -> None:
+        """Store the answer chunks of key, written to disk in the background"""
+        entry = CacheEntry(created=time.time(), chunks=chunks)
+        self._remember(key, entry)
+        if self._executor is not None:
+            self._executor.submit(self._write, key, entry)
+
+    def clear(self) -> None:
+        """Forget every entry, files are removed in the background"""
+        self._memory.clear()
+        if self._executor is not None:
+            self._executor.submit(self._clear_files)
+
+    async def close(self) -> None:
+        """Wait for the pending disk writes and stop the disk thread"""
+        if self._executor is not None:
+            await asyncio.to_thread(self._executor.shutdown, wait=True)
+
+    def _remember(self, key: str, entry: CacheEntry) -> None:
+        self._memory[key] = entry
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _forget(self, key: str) -> None:
+        self._memory.pop(key, None)
+        if self._executor is not None:
+            self._executor.submit(self._drop_file, key)
+
+    # Everything below runs on the disk thread
+
+    def _clear_files(self) -> None:
+        for key in list(self._disk_index()):
+            self._drop_file(key)
+
+    def _drop_file(self, key: str) -> None:
+        disk = self._disk_index()
+        if key in disk:
+            self._disk_bytes -= disk.pop(key)
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def _path(self, key: str) -> str:
+        assert self.directory is not None
+        return os.path.join(self.directory, f"{key}.json")
+
+    def _disk_index(self) -> OrderedDict[str, int]:
+        """Sizes of the files on disk, loaded once and kept in LRU order"""
+        if self._disk is None:
+            self._disk = OrderedDict()
+            if self.directory is not None and os.path.isdir(self.directory):
+                files = []
+                with os.scandir(self.directory) as it:
+                    for f in it:
+                        if f.name.endswith(".json"):
+                            stat = f.stat()
+                            files.append((stat.st_mtime, f.name[:-5], stat.st_size))
+                for _, key, size in sorted(files):
+                    self._disk[key] = size
+                    self._disk_bytes += size
+        return self._disk
+
+    def _read(self, key: str) -> CacheEntry | None:
+        if key not in self._disk_index():
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                entry = self._decoder.decode(f.read())
+        except (OSError, msgspec.DecodeError) as e:
+            logger.warning("Dropping unreadable cache entry %s: %s", key, e)
+            self._drop_file(key)
+            return None
+        self._disk_index().move_to_end(key)
+        return entry
+
+    def _write(self, key: str, entry: CacheEntry) -> None:
+        assert self.directory is not None
+        data = self._encoder.encode(entry)
+        if len(data) > self.max_disk_bytes:
+            return
+        disk = self._disk_index()
+        if key in disk:
+            self._disk_bytes -= disk.pop(key)
+        while disk and self._disk_bytes + len(data) > self.max_disk_bytes:
+            self._drop_file(next(iter(disk)))
+        tmp_path = f"{self._path(key)}.tmp"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            logger.warning("Could not write cache entry %s: %s", key, e)
+            return
+        disk[key] = len(data)
+        self._disk_bytes += len(data)
@@ -0,0 +1,93 @@
+import asyncio
+from typing import Any, AsyncGenerator, Self
+
+from .api import DuckChat
+from .connection import ConnectionPool, get_default_pool
+from .models import ModelType
+from .ratelimit import Priority
+
+
+class Conversation:
+    """One conversation owned by a DuckChatPool"""
+
+    def __init__(self, chat: DuckChat) -> None:
+        self.chat = chat
+        # asyncio.Lock wakes waiters first-in first-out, so turns run in submit order
+        self.turn_lock = asyncio.Lock()
+        self.turns = 0
+
+
+class DuckChatPool:
+    """Run many independent conversations concurrently
+
+    Every conversation has its own DuckChat (history and vqd tokens) and its
+    turns are serialized in submission order. A global semaphore caps how many
+    turns are in flight across all conversations, and every DuckChat shares
+    the same connection pool.
+    """
+
+    def __init__(
+        self,
+        model: ModelType = ModelType.Claude,
+        concurrency: int = 16,
+        pool: ConnectionPool | None = None,
+        **chat_kwargs: Any,
+    ) -> None:
+        self.model = model
+        self.concurrency = concurrency
+        self._pool = pool or get_default_pool()
+        self._chat_kwargs = chat_kwargs
+        # Pooled turns are background work, interactive chats go ahead of them
+        self._chat_kwargs.setdefault("priority", Priority.batch)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._conversations: dict[str, Conversation] = {}
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.aclose()
+
+    def __len__(self) -> int:
+        return len(self._conversations)
+
+    def __contains__(self, conv_id: str) -> bool:
+        return conv_id in self._conversations
+
+    def conversation(self, conv_id: str, model: ModelType | None = None) -> Conversation:
+        """Get conversation by id, creating it on first use"""
+        conversation = self._conversations.get(conv_id)
+        if conversation is None:
+            chat = DuckChat(model=model or self.model, pool=self._pool, **self._chat_kwargs)
+            conversation = self._conversations[conv_id] = Conversation(chat)
+        return conversation
+
+    async def submit(self, conv_id: str, prompt: str) -> str:
+        """Queue a turn for conversation ``conv_id`` and wait for the answer"""
+        conversation = self.conversation(conv_id)
+        async with conversation.turn_lock:
+            async with self._semaphore:
+                answer = await conversation.chat.ask_question(prompt)
+            conversation.turns += 1
+        return answer
+
+    async def submit_stream(self, conv_id: str, prompt: str) -> AsyncGenerator[str, None]:
+        """Queue a turn for conversation ``conv_id`` and stream the answer"""
+        conversation = self.conversation(conv_id)
+        async with conversation.turn_lock:
+            async with self._semaphore:
+                async for chunk in conversation.chat.ask_question_stream(prompt):
+                    yield chunk
+            conversation.turns += 1
+
+    async def close(self, conv_id: str) -> None:
+        """Finish conversation ``conv_id`` once its queued turns are done"""
+        conversation = self._conversations.pop(conv_id, None)
+        if conversation is None:
+            return
+        async with conversation.turn_lock:
+            await conversation.chat.close_session()
+
+    async def aclose(self) -> None:
+        """Close every conversation"""
+        await asyncio.gather(*(self.close(conv_id) for conv_id in list(self._conversations)))
@@ -1,17 +1,21 @@
 import argparse
 import asyncio
+import functools
 import readline
 import sys
-import toml
 from pathlib import Path
-import glob
-
-from rich.console import Console
-from rich.markdown import Markdown
+import time
+from typing import TYPE_CHECKING
 
 from .api import DuckChat
+from .budget import CompactionStrategy, ContextBudget
 from .exceptions import DuckChatException
+from .metrics import REGISTRY
 from .models import ModelType, SavedHistory
+from .models.models import LOG_FORMATS
+
+if TYPE_CHECKING:
+    from .mock_server import MockChatServer
 
 HELP_MSG = (
     "\033[1;1m- /help         \033[0mDisplay the help message\n"
@@ -23,7 +27,10 @@ HELP_MSG = (
     "\033[1;1m- /retry        \033[0mRegenerate answer to № prompt (default /retry 1)\n"
     "\033[1;1m- /save         \033[0mSave the current conversation history\n"
     "\033[1;1m- /load [ID]    \033[0mLoad a conversation history by ID\n"
-    "\033[1;1m- /list_histories \033[0mList all saved conversation histories\n"
+    "\033[1;1m- /list_histories [page] \033[0mList saved conversation histories, newest first\n"
+    "\033[1;1m- /search <terms> \033[0mSearch saved conversation histories\n"
+    "\033[1;1m- /reindex      \033[0mRebuild the saved history index from the history files\n"
+    "\033[1;1m- /stats        \033[0mShow request latency and error statistics\n"
 )
 
 COMMANDS = {
@@ -34,8 +41,19 @@ COMMANDS = {
     "retry",
     "stream_on",
     "stream_off",
+    "stats",
+    "save",
+    "load",
+    "list_histories",
+    "search",
+    "reindex",
 }
 
+# Number of histories shown per /list_histories page
+HISTORY_PAGE_SIZE = 20
+
+DAY = 24 * 3600
+
 
 def completer(text: str, state: int) -> str | None:
     origline = readline.get_line_buffer()
@@ -50,19 +68,30 @@ def completer(text: str, state: int) -> str | None:
 
 
 class CLI:
-    def __init__(self) -> None:
+    def __init__(self, metrics_port: int | None = None, compact: str | None = None) -> None:
         readline.parse_and_bind("tab: complete")
         readline.set_completer(completer)
         self.INPUT_MODE = "singleline"
         self.STREAM_MODE = False
         self.COUNT = 1
-        self.console = Console()
+        self.metrics_port = metrics_port
+        self.context_budget = ContextBudget(CompactionStrategy(compact)) if compact else None
+
+    @functools.cached_property
+    def console(self):
+        # rich is only needed to render code blocks, keep it out of the startup path
+        from rich.console import Console
+
+        return Console()
 
     async def run(self) -> None:
         """Base loop program"""
         model = self.read_model_from_conf()
         print(f"Using \033[1;4m{model.value}\033[0m")
-        async with DuckChat(model) as chat:
+        if self.metrics_port is not None:
+            await REGISTRY.serve(self.metrics_port)
+            print(f"Serving metrics on http://127.0.0.1:{self.metrics_port}/metrics")
+        async with DuckChat(model, context_budget=self.context_budget) as chat:
             print("Type \033[1;4m/help\033[0m to display the help")
 
             while True:
@@ -143,6 +172,8 @@ class CLI:
                 sys.exit(0)
             case "help":
                 print(HELP_MSG)
+            case "stats":
+                print(REGISTRY.summary())
             case "retry":
                 if self.COUNT == 1:
                     return
@@ -178,18 +209,40 @@ class CLI:
                 chat.history = DuckChat.load_history(history_id)
                 print(f"Loaded history with ID: {history_id}")
             case "list_histories":
-                histories = glob.glob("history_*.json")
-                if not histories:
+                try:
+                    page = max(int(args[1]), 1) if len(args) > 1 else 1
+                except ValueError:
+                    print("Page must be a number")
+                    return
+                entries = SavedHistory.index.list(offset=(page - 1) * HISTORY_PAGE_SIZE, limit=HISTORY_PAGE_SIZE)
+                if not entries:
                     print("No histories found.")
-                else:
-                    for history in histories:
-                        print(history)
+                    return
+                pages = -(-SavedHistory.index.count() // HISTORY_PAGE_SIZE)
+                for entry in entries:
+                    updated = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry.updated))
+                    print(f"\033[1;1m{entry.id}\033[0m  {updated}  {entry.message_count:>4} messages  {entry.preview}")
+                print(f"Page {page}/{pages}")
+            case "search":
+                terms = " ".join(args[1:])
+                if not terms:
+                    print("You must provide terms to search for.")
+                    return
+                hits = SavedHistory.index.search(terms, highlight=("\033[1;4m", "\033[0m"))
+                if not hits:
+                    print("No matching messages.")
+                for hit in hits:
+                    print(f"\033[1;1m{hit.history_id}\033[0m #{hit.position} {hit.role}: {hit.snippet}")
+            case "reindex":
+                print(f"Indexed {SavedHistory.index.rebuild()} histories")
             case _:
                 print("Command doesn't find")
                 print("Type \033[1;4m/help\033[0m to display the help")
 
     def answer_print(self, query: str) -> None:
         if "`" in query:  # block of code
+            from rich.markdown import Markdown
+
             self.console.print(Markdown(query))
         else:
             print(query)
@@ -197,6 +250,8 @@ class CLI:
     def read_model_from_conf(self) -> ModelType:
         filepath = Path.home() / ".config" / "hey" / "conf.toml"
         if filepath.exists():
+            import toml
+
             with open(filepath, "r") as f:
                 conf = toml.load(f)
                 model_name = conf["model"]
@@ -207,13 +262,214 @@ class CLI:
         return ModelType.Claude
 
 
+def add_mock_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--chunk-tokens", type=int, default=1, help="Answer tokens per SSE event (default 1)")
+    parser.add_argument("--token-delay", type=float, default=0.0, metavar="SECONDS", help="Delay between SSE events")
+    parser.add_argument(
+        "--first-token-delay", type=float, default=0.0, metavar="SECONDS", help="Delay before the first SSE event"
+    )
+    parser.add_argument("--no-vqd-rotation", action="store_true", help="Keep accepting the same x-vqd-4 token")
+    parser.add_argument("--ratelimit-rate", type=float, default=0.0, help="Share of requests answered with a 429")
+    parser.add_argument(
+        "--conversation-limit-rate", type=float, default=0.0, help="Share of requests answered ERR_CONVERSATION_LIMIT"
+    )
+    parser.add_argument("--conversation-limit", type=int, help="Refuse conversations longer than this many questions")
+
+
+def mock_server(args: argparse.Namespace, port: int = 0) -> "MockChatServer":
+    from .mock_server import MockChatServer
+
+    return MockChatServer(
+        port=port,
+        chunk_tokens=args.chunk_tokens,
+        token_delay=args.token_delay,
+        first_token_delay=args.first_token_delay,
+        rotate_vqd=not args.no_vqd_rotation,
+        ratelimit_rate=args.ratelimit_rate,
+        conversation_limit_rate=args.conversation_limit_rate,
+        conversation_limit=args.conversation_limit,
+    )
+
+
+async def serve_mock(args: argparse.Namespace) -> None:
+    async with mock_server(args, args.port) as server:
+        print(f"Mock chat API on {server.base_url}, Ctrl+C to stop")
+        await asyncio.Event().wait()
+
+
+async def load_test(args: argparse.Namespace) -> None:
+    from .loadgen import run_load
+
+    if args.url:
+        report = await run_load(args.url, users=args.users, turns=args.turns, rate=args.rate)
+    else:
+        async with mock_server(args) as server:
+            report = await run_load(server.base_url, users=args.users, turns=args.turns, rate=args.rate)
+    print(report.summary())
+
+
+def batch(args: argparse.Namespace) -> None:
+    from .batch import run_batch, run_sharded_batch, shard_limiter
+
+    chat_kwargs = {}
+    if args.url:
+        chat_kwargs["base_url"] = args.url
+    if args.processes is not None:
+        if args.checkpoint:
+            print("--checkpoint is not supported with --processes, every shard has its own")
+            return
+        stats = run_sharded_batch(
+            args.input,
+            args.output,
+            processes=args.processes or None,
+            concurrency=args.concurrency,
+            rate=args.rate,
+            model=ModelType[args.model],
+            resume=not args.restart,
+            retry_errors=args.retry_errors,
+            **chat_kwargs,
+        )
+    else:
+        if args.rate is not None:
+            chat_kwargs["rate_limiter"] = shard_limiter(args.rate)
+        stats = asyncio.run(
+            run_batch(
+                args.input,
+                args.output,
+                concurrency=args.concurrency,
+                model=ModelType[args.model],
+                checkpoint_path=args.checkpoint,
+                resume=not args.restart,
+                retry_errors=args.retry_errors,
+                **chat_kwargs,
+            )
+        )
+    print(f"{stats.done} answered, {stats.failed} failed, {stats.skipped} already done")
+    print(REGISTRY.summary())
+
+
+async def serve(args: argparse.Namespace) -> None:
+    from .gateway import ChatGateway
+
+    gateway = ChatGateway(
+        host=args.host,
+        port=args.port,
+        concurrency=args.concurrency,
+        queue_size=args.queue_size,
+        drain_timeout=args.drain_timeout,
+        coalesce=args.coalesce,
+        **({"base_url": args.url} if args.url else {}),
+    )
+    print(f"OpenAI compatible API on http://{args.host}:{args.port}/v1, Ctrl+C to stop")
+    await gateway.serve_forever()
+
+
 def safe_entry_point() -> None:
     parser = argparse.ArgumentParser(description="A simple CLI tool.")
     parser.add_argument("--generate", action="store_true", help="Generate new models")
+    parser.add_argument(
+        "--metrics-port", type=int, metavar="PORT", help="Serve Prometheus metrics on localhost:PORT/metrics"
+    )
+    parser.add_argument(
+        "--history-format",
+        choices=sorted(LOG_FORMATS),
+        help="Format new history logs are written in (default json), existing ones move to it when rewritten",
+    )
+    parser.add_argument(
+        "--compact",
+        choices=[strategy.value for strategy in CompactionStrategy],
+        help="Compact the conversation this way when it outgrows the context budget of the model",
+    )
+    parser.add_argument("--reindex", action="store_true", help="Rebuild the saved history index and exit")
+    parser.add_argument(
+        "--archive-after",
+        type=float,
+        metavar="DAYS",
+        help="Pack histories untouched for DAYS into compressed archive segments and exit",
+    )
+    parser.add_argument(
+        "--retention-days",
+        type=float,
+        metavar="DAYS",
+        help="With --archive-after, delete archived histories older than DAYS",
+    )
+    parser.add_argument(
+        "--retention-mb", type=float, metavar="MB", help="With --archive-after, cap the archive at MB megabytes"
+    )
+    subparsers = parser.add_subparsers(dest="command", metavar="COMMAND")
+    mock_parser = subparsers.add_parser("mock-server", help="Serve a local stand-in of the chat API")
+    mock_parser.add_argument("--port", type=int, default=8080, help="Port to listen on (default 8080)")
+    add_mock_arguments(mock_parser)
+    load_parser = subparsers.add_parser(
+        "loadgen", help="Measure latency and throughput of virtual users, against a mock server by default"
+    )
+    load_parser.add_argument("--url", help="Base URL of the chat API, a mock server is started if omitted")
+    load_parser.add_argument("--users", type=int, default=10, help="Concurrent virtual users (default 10)")
+    load_parser.add_argument("--turns", type=int, default=5, help="Questions per user (default 5)")
+    load_parser.add_argument("--rate", type=float, help="Cap requests per second through the rate limiter")
+    add_mock_arguments(load_parser)
+    batch_parser = subparsers.add_parser(
+        "batch", help="Answer a JSONL file of independent conversations, resuming where a previous run stopped"
+    )
+    batch_parser.add_argument("--input", required=True, help='JSONL file of {"id": ..., "prompt": ...} records')
+    batch_parser.add_argument("--output", required=True, help="JSONL file results are appended to as they finish")
+    batch_parser.add_argument("--concurrency", type=int, default=8, help="Conversations in flight (default 8)")
+    batch_parser.add_argument(
+        "--model", choices=[model.name for model in ModelType], default=ModelType.Claude.name, help="Default model"
+    )
+    batch_parser.add_argument("--checkpoint", help="Checkpoint file (default OUTPUT.ckpt)")
+    batch_parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and overwrite the output")
+    batch_parser.add_argument("--retry-errors", action="store_true", help="Run failed conversations again")
+    batch_parser.add_argument("--rate", type=float, help="Requests per second budget of the whole batch")
+    batch_parser.add_argument("--url", help="Base URL of the chat API, e.g. a duck_chat mock-server")
+    batch_parser.add_argument(
+        "--processes",
+        type=int,
+        nargs="?",
+        const=0,
+        metavar="N",
+        help="Shard the batch over N worker processes (one per core if N is omitted), "
+        "--concurrency and --rate are split between them",
+    )
+    serve_parser = subparsers.add_parser("serve", help="Serve an OpenAI compatible /v1/chat/completions API")
+    serve_parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default 127.0.0.1)")
+    serve_parser.add_argument("--port", type=int, default=8000, help="Port to listen on (default 8000)")
+    serve_parser.add_argument("--concurrency", type=int, default=16, help="Requests sent upstream at once (default 16)")
+    serve_parser.add_argument("--queue-size", type=int, default=64, help="Requests waiting for a slot (default 64)")
+    serve_parser.add_argument("--drain-timeout", type=float, default=30.0, help="Seconds to finish streams on exit")
+    serve_parser.add_argument("--url", help="Base URL of the chat API, e.g. a duck_chat mock-server")
+    serve_parser.add_argument(
+        "--coalesce", action="store_true", help="Send identical requests in flight at the same time upstream once"
+    )
     args = parser.parse_args()
-    if args.generate:
+    if args.command == "serve":
+        asyncio.run(serve(args))
+        return
+    if args.command == "mock-server":
+        asyncio.run(serve_mock(args))
+        return
+    if args.command == "loadgen":
+        asyncio.run(load_test(args))
+        return
+    if args.command == "batch":
+        batch(args)
+        return
+    if args.history_format:
+        SavedHistory.format = args.history_format
+    if args.reindex:
+        print(f"Indexed {SavedHistory.index.rebuild()} histories")
+    elif args.archive_after is not None:
+        archive = SavedHistory.archive
+        print(f"Archived {archive.pack(args.archive_after * DAY)} histories")
+        if args.retention_days is not None or args.retention_mb is not None:
+            deleted = archive.enforce_retention(
+                max_age=args.retention_days * DAY if args.retention_days is not None else None,
+                max_bytes=int(args.retention_mb * 1024 * 1024) if args.retention_mb is not None else None,
+            )
+            print(f"Deleted {deleted} archived histories")
+    elif args.generate:
         from .models.generate_models import main as generator
 
         generator()
     else:
-        asyncio.run(CLI().run())
+        asyncio.run(CLI(metrics_port=args.metrics_port, compact=args.compact).run())
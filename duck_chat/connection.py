@@ -0,0 +1,147 @@
+import asyncio
+import logging
+from types import SimpleNamespace
+from typing import Any, Self
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+WARM_UP_URL = "https://duckduckgo.com/duckchat/v1/status"
+
+
+class ConnectionPool:
+    """TCP connection pool that many DuckChat instances can share
+
+    Every session handed out by ``session()`` uses the same connector, so DNS
+    answers are cached once and keep-alive sockets are reused between
+    conversations instead of paying a new TLS handshake each time.
+    """
+
+    def __init__(
+        self,
+        limit: int = 100,
+        limit_per_host: int = 0,
+        ttl_dns_cache: int | None = 300,
+        keepalive_timeout: float = 30.0,
+    ) -> None:
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.ttl_dns_cache = ttl_dns_cache
+        self.keepalive_timeout = keepalive_timeout
+
+        self.created = 0  # new sockets opened
+        self.reused = 0  # requests served by an already open socket
+        self.queued = 0  # requests that had to wait for a free slot
+
+        self._connector: aiohttp.TCPConnector | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._trace_config = aiohttp.TraceConfig()
+        self._trace_config.on_connection_create_end.append(self._on_create)
+        self._trace_config.on_connection_reuseconn.append(self._on_reuse)
+        self._trace_config.on_connection_queued_start.append(self._on_queued)
+        self._trace_config.freeze()
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.close()
+
+    @property
+    def connector(self) -> aiohttp.TCPConnector:
+        """Connector bound to the running event loop, created on first use"""
+        loop = asyncio.get_running_loop()
+        if self._connector is None or self._connector.closed or self._loop is not loop:
+            if self._connector is not None:
+                self._retire(self._connector, self._loop)
+            self._connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                ttl_dns_cache=self.ttl_dns_cache,
+                use_dns_cache=self.ttl_dns_cache is not None,
+                keepalive_timeout=self.keepalive_timeout,
+            )
+            self._loop = loop
+        return self._connector
+
+    @staticmethod
+    def _retire(connector: aiohttp.TCPConnector, loop: asyncio.AbstractEventLoop | None) -> None:
+        """Close a connector bound to another event loop than the running one"""
+        if connector.closed:
+            return
+        if loop is not None and loop.is_running():
+            # Its sockets belong to that loop, close them from there
+            asyncio.run_coroutine_threadsafe(_close_connector(connector), loop)
+        elif hasattr(connector, "_close"):
+            # Synchronous first half of close(), nothing left to wait for on a stopped or closed loop.
+            # Private, checked with aiohttp 3.9.5, 3.10.11 and 3.14.5
+            connector._close()
+        elif loop is not None and not loop.is_closed():
+            loop.run_until_complete(_close_connector(connector))
+
+    @property
+    def reuse_ratio(self) -> float:
+        """Share of connections served from already open sockets"""
+        total = self.created + self.reused
+        return self.reused / total if total else 0.0
+
+    def session(
+        self,
+        headers: dict[str, str] | None = None,
+        trace_configs: list[aiohttp.TraceConfig] | None = None,
+    ) -> aiohttp.ClientSession:
+        """Create a client session backed by the shared connector
+
+        Closing the returned session does not close the pooled sockets.
+        """
+        return aiohttp.ClientSession(
+            connector=self.connector,
+            connector_owner=False,
+            headers=headers,
+            trace_configs=[self._trace_config, *(trace_configs or [])],
+        )
+
+    async def warm_up(self, connections: int = 1, url: str = WARM_UP_URL) -> None:
+        """Open ``connections`` sockets ahead of time so first requests skip DNS and TLS"""
+        async with self.session() as session:
+
+            async def touch() -> None:
+                try:
+                    async with session.head(url) as response:
+                        await response.release()
+                except aiohttp.ClientError as e:
+                    logger.warning("Connection warm-up failed: %s", e)
+
+            await asyncio.gather(*(touch() for _ in range(connections)))
+
+    async def close(self) -> None:
+        """Close every pooled socket"""
+        if self._connector is not None:
+            await self._connector.close()
+            self._connector = None
+            self._loop = None
+
+    async def _on_create(self, session: aiohttp.ClientSession, ctx: SimpleNamespace, params: Any) -> None:
+        self.created += 1
+
+    async def _on_reuse(self, session: aiohttp.ClientSession, ctx: SimpleNamespace, params: Any) -> None:
+        self.reused += 1
+
+    async def _on_queued(self, session: aiohttp.ClientSession, ctx: SimpleNamespace, params: Any) -> None:
+        self.queued += 1
+
+
+_default_pool: ConnectionPool | None = None
+
+
+def get_default_pool() -> ConnectionPool:
+    """Process-wide connection pool"""
+    global _default_pool
+    if _default_pool is None:
+        _default_pool = ConnectionPool()
+    return _default_pool
+
+
+async def _close_connector(connector: aiohttp.BaseConnector) -> None:
+    await connector.close()
@@ -0,0 +1,352 @@
+import asyncio
+import logging
+import signal
+import time
+import uuid
+from typing import Any, Self
+
+import msgspec
+from aiohttp import web
+
+from .api import DEFAULT_BASE_URL, DuckChat
+from .connection import ConnectionPool
+from .exceptions import ConversationLimitException, DuckChatException, RatelimitException
+from .models import History, ModelType
+from .models.models import Message, Role
+from .ratelimit import RateLimiter
+from .singleflight import SingleFlight
+from .vqd import VqdPrefetcher
+
+logger = logging.getLogger(__name__)
+
+
+class ContentPart(msgspec.Struct):
+    type: str
+    text: str = ""
+
+
+class ChatMessage(msgspec.Struct):
+    role: str
+    content: str | list[ContentPart] | None = None
+
+    @property
+    def text(self) -> str:
+        if isinstance(self.content, list):
+            return "".join(part.text for part in self.content if part.type == "text")
+        return self.content or ""
+
+
+class ChatCompletionRequest(msgspec.Struct):
+    """The fields of an OpenAI /v1/chat/completions request the gateway uses, others are ignored"""
+    model: str
+    messages: list[ChatMessage]
+    stream: bool = False
+
+
+class GatewayError(Exception):
+    """Answered to the client as an OpenAI error object"""
+
+    def __init__(self, status: int, message: str, error_type: str, code: str | None = None) -> None:
+        super().__init__(message)
+        self.status = status
+        self.error_type = error_type
+        self.code = code
+
+    def body(self) -> dict[str, Any]:
+        return {"error": {"message": str(self), "type": self.error_type, "param": None, "code": self.code}}
+
+
+def resolve_model(name: str) -> ModelType:
+    """ModelType of an OpenAI model name: a ModelType value ("gpt-4o-mini") or name ("claude")"""
+    for model in ModelType:
+        if name == model.value or name.lower() == model.name.lower():
+            return model
+    raise GatewayError(404, f"The model {name!r} does not exist", "invalid_request_error", "model_not_found")
+
+
+def to_history(model: ModelType, messages: list[ChatMessage]) -> History:
+    """OpenAI messages as a DuckChat history
+
+    The chat API has no system role, system messages are put in front of
+    the next user message.
+    """
+    history = History(model=model, messages=[])
+    system: list[str] = []
+    for message in messages:
+        if message.role in ("system", "developer"):
+            system.append(message.text)
+        elif message.role == "user":
+            history.messages.append(Message(Role.user, "\n\n".join([*system, message.text])))
+            system = []
+        elif message.role == "assistant":
+            history.messages.append(Message(Role.assistant, message.text))
+        else:
+            raise GatewayError(400, f"Unsupported message role {message.role!r}", "invalid_request_error")
+    if not history.messages or history.messages[-1].role is not Role.user:
+        raise GatewayError(400, "The last message must come from the user", "invalid_request_error")
+    return history
+
+
+class ChatGateway:
+    """OpenAI compatible /v1/chat/completions server in front of DuckChat
+
+    Every request is answered by a fresh DuckChat over the shared
+    connection pool, rate limiter and x-vqd-4 token prefetcher, so one warm
+    process serves many clients. Requests are stateless, the client sends
+    the whole conversation each time as with OpenAI.
+
+    At most ``concurrency`` requests are sent upstream at once, up to
+    ``queue_size`` more wait for a slot (at most ``queue_timeout``
+    seconds) and the rest are refused with a 429 right away. Streams are
+    written at the pace the client reads them. ``stop()`` refuses new
+    requests and lets the ones in flight finish, up to ``drain_timeout``.
+    With ``coalesce``, identical requests in flight at the same time share
+    one upstream request (see SingleFlight).
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 8000,
+        concurrency: int = 16,
+        queue_size: int = 64,
+        queue_timeout: float = 30.0,
+        drain_timeout: float = 30.0,
+        prefetch: int = 4,
+        rate_limiter: RateLimiter | None = None,
+        base_url: str = DEFAULT_BASE_URL,
+        coalesce: bool = False,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.drain_timeout = drain_timeout
+        self.base_url = base_url
+
+        self.served = 0
+        self.rejected = 0
+        self.failed = 0
+
+        self._pool = ConnectionPool(limit=concurrency + prefetch)
+        self._rate_limiter = rate_limiter or RateLimiter()
+        self._prefetcher = VqdPrefetcher(
+            size=prefetch, pool=self._pool, rate_limiter=self._rate_limiter, base_url=base_url
+        )
+        self._singleflight = SingleFlight() if coalesce else None
+        self._slots = asyncio.Semaphore(concurrency)
+        self._admitted = 0  # requests holding or waiting for a slot
+        self._in_flight: set[asyncio.Task[Any]] = set()
+        self._draining = False
+        self._encoder = msgspec.json.Encoder()
+        self._decoder = msgspec.json.Decoder(ChatCompletionRequest)
+        self._runner: web.AppRunner | None = None
+
+    async def __aenter__(self) -> Self:
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.stop()
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_get("/v1/models", self.models)
+        return app
+
+    async def start(self) -> None:
+        self._draining = False
+        self._prefetcher.start()
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        # Resolve port 0 to the port actually bound
+        self.port = self._runner.addresses[0][1]
+        logger.info("Chat gateway listening on %s", self.url)
+
+    async def stop(self) -> None:
+        """Refuse new requests, wait for the ones in flight, then close everything"""
+        self._draining = True
+        if self._in_flight:
+            logger.info("Draining %d requests", len(self._in_flight))
+            _, pending = await asyncio.wait(self._in_flight, timeout=self.drain_timeout)
+            for task in pending:
+                task.cancel()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        await self._prefetcher.stop()
+        await self._pool.close()
+
+    async def serve_forever(self) -> None:
+        """Serve until SIGINT or SIGTERM, then drain"""
+        stopped = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stopped.set)
+            except NotImplementedError:  # Windows, Ctrl+C raises KeyboardInterrupt instead
+                pass
+        await self.start()
+        try:
+            await stopped.wait()
+        finally:
+            await self.stop()
+
+    async def models(self, request: web.Request) -> web.Response:
+        data = [{"id": model.value, "object": "model", "owned_by": "duckduckgo"} for model in ModelType]
+        return self._json({"object": "list", "data": data})
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        task = asyncio.current_task()
+        assert task is not None
+        self._in_flight.add(task)
+        try:
+            return await self._complete(request)
+        except GatewayError as e:
+            if e.status >= 500:
+                self.failed += 1
+            return self._json(e.body(), status=e.status, headers={"Retry-After": "1"} if e.status == 429 else None)
+        finally:
+            self._in_flight.discard(task)
+
+    async def _complete(self, request: web.Request) -> web.StreamResponse:
+        if self._draining:
+            raise GatewayError(503, "The gateway is shutting down", "server_error", "shutting_down")
+        try:
+            body = self._decoder.decode(await request.read())
+        except msgspec.DecodeError as e:
+            raise GatewayError(400, f"Invalid request: {e}", "invalid_request_error")
+        model = resolve_model(body.model)
+        history = to_history(model, body.messages)
+
+        async with self._slot():
+            chat = DuckChat(
+                model,
+                pool=self._pool,
+                rate_limiter=self._rate_limiter,
+                prefetcher=self._prefetcher,
+                base_url=self.base_url,
+                singleflight=self._singleflight,
+            )
+            async with chat:
+                chat.history = history
+                try:
+                    await chat.get_vqd()
+                    if body.stream:
+                        return await self._stream(request, chat)
+                    answer = "".join([chunk async for chunk in chat.stream_answer()])
+                except DuckChatException as e:
+                    raise upstream_error(e)
+        self.served += 1
+        return self._json(
+            {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": model.value,
+                "choices": [
+                    {"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}
+                ],
+            }
+        )
+
+    async def _stream(self, request: web.Request, chat: DuckChat) -> web.StreamResponse:
+        chunks = chat.stream_answer()
+        # Wait for the first chunk, errors before it are still answered with a status code
+        try:
+            first = await anext(chunks)
+        except StopAsyncIteration:
+            first = ""
+        except BaseException:
+            await chunks.aclose()
+            raise
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+        model = chat.history.model.value
+
+        def event(delta: dict[str, str], finish_reason: str | None = None) -> bytes:
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            return b"data: " + self._encoder.encode(chunk) + b"\n\n"
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        try:
+            await response.write(event({"role": "assistant", "content": first}))
+            # write() waits for the socket to drain, a slow client slows the upstream read down
+            async for chunk in chunks:
+                await response.write(event({"content": chunk}))
+        except ConnectionResetError:
+            logger.debug("Client went away mid stream")
+            return response
+        except DuckChatException as e:
+            error = upstream_error(e)
+            self.failed += 1
+            await response.write(b"data: " + self._encoder.encode(error.body()) + b"\n\n")
+        else:
+            await response.write(event({}, "stop"))
+            self.served += 1
+        finally:
+            await chunks.aclose()
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    def _slot(self) -> "_Slot":
+        if self._admitted >= self.concurrency + self.queue_size:
+            self.rejected += 1
+            raise GatewayError(429, "Too many requests queued, retry later", "rate_limit_exceeded", "queue_full")
+        return _Slot(self)
+
+    def _json(self, data: Any, status: int = 200, headers: dict[str, str] | None = None) -> web.Response:
+        return web.Response(
+            body=self._encoder.encode(data), status=status, headers=headers, content_type="application/json"
+        )
+
+
+class _Slot:
+    """One of the ``concurrency`` upstream slots, waited for in the bounded queue"""
+
+    def __init__(self, gateway: ChatGateway) -> None:
+        self.gateway = gateway
+
+    async def __aenter__(self) -> None:
+        gateway = self.gateway
+        gateway._admitted += 1
+        try:
+            await asyncio.wait_for(gateway._slots.acquire(), timeout=gateway.queue_timeout)
+        except asyncio.TimeoutError:
+            gateway._admitted -= 1
+            gateway.rejected += 1
+            raise GatewayError(503, "Timed out waiting for a free slot", "server_error", "queue_timeout") from None
+        except BaseException:
+            gateway._admitted -= 1
+            raise
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        self.gateway._slots.release()
+        self.gateway._admitted -= 1
+
+
+def upstream_error(e: DuckChatException) -> GatewayError:
+    """OpenAI error matching an error of the chat API"""
+    if isinstance(e, ConversationLimitException):
+        return GatewayError(
+            400, str(e) or "Conversation limit reached", "invalid_request_error", "context_length_exceeded"
+        )
+    if isinstance(e, RatelimitException):
+        return GatewayError(429, str(e) or "Rate limited upstream", "rate_limit_exceeded", "rate_limit_exceeded")
+    return GatewayError(502, str(e) or "Upstream error", "server_error", "upstream_error")
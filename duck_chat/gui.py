@@ -16,17 +16,22 @@ from kivy.uix.recycleview.views import RecycleDataViewBehavior
 from kivy.uix.behaviors import FocusBehavior
 from kivy.uix.recycleview.layout import LayoutSelectionBehavior
 from kivy.properties import BooleanProperty
+from kivy.core.image import Image as CoreImage
+from kivy.core.text import Label as CoreLabel
+from kivy.core.window import Window
 from kivy.metrics import dp
 import os
 import platform
-import glob
 import logging
 from enum import Enum
 import asyncio
-import threading
+from collections import deque
 import aiohttp
 from duck_chat.api import DuckChat, DuckChatException
 from .models.models import Role, SavedHistory, History
+from .models.pager import HistoryPager
+from .persistence import HistoryWriter
+from .worker import LoopThread
 import sys
 import datetime
 from datetime import timedelta
@@ -46,11 +51,17 @@ class ModelType(Enum):
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Ensure the saved history directory exists
+# Saved history directory, created when the app starts
 SAVE_DIR = os.path.join(os.path.dirname(__file__), '..', 'savedhistory')
-logger.info(f"Saving histories in directory: {os.path.abspath(SAVE_DIR)}")
-if not os.path.exists(SAVE_DIR):
-    os.makedirs(SAVE_DIR)
+
+# Number of histories shown per /list_histories page
+HISTORY_PAGE_SIZE = 20
+
+# Messages shown when a saved conversation is opened, and per "Load older messages"
+HISTORY_PAGE_MESSAGES = 50
+
+# Default age in days of the conversations /archive packs into the compressed archive
+ARCHIVE_AFTER_DAYS = 30
 
 def resource_path(relative_path):
     """Get the absolute path to the resource, works for PyInstaller"""
@@ -65,22 +76,39 @@ def get_current_datetime(days_offset=0):
     target_date = datetime.now() + timedelta(days=days_offset)
     return target_date.strftime("%Y-%m-%d %H:%M:%S")
 
-def load_saved_conversations(directory):
-    """Browse the saved conversations folder and return a list of file paths."""
-    logger.info(f"Welcome to load_saved_conversations")
-
-    logger.info(f"Searching for saved conversations in directory: {directory}")
-    
-    history_files = glob.glob(os.path.join(directory, "history_*.json"))
-    logger.info(f"Found {len(history_files)} saved conversation files.")
-    
-    if not history_files:
-        logger.error("No saved conversations were found. Please ensure there are files in the directory.")
-    
-    for file in history_files:
-        logger.info(f"Adding file to saved_history_files: {file}")
-    
-    return history_files  # Return the list of conversation file paths
+def load_saved_conversations(limit=200):
+    """Return the most recently updated saved conversations from the history index."""
+    entries = SavedHistory.index.list(limit=limit)
+    logger.info(f"Found {len(entries)} saved conversations in the history index.")
+    return entries
+
+def history_list_data(entries):
+    """RecycleView data for a list of history index entries"""
+    if not entries:
+        return [{'text': 'No saved conversations found.', 'selectable': False, 'history_id': None}]
+    data = [{'text': 'Saved History', 'selectable': False, 'history_id': None}]
+    for entry in entries:
+        updated = datetime.datetime.fromtimestamp(entry.updated).strftime("%Y-%m-%d %H:%M")
+        preview = entry.preview or entry.id
+        data.append({
+            'text': f"{updated} ({entry.message_count})  {preview}",
+            'selectable': True,
+            'history_id': entry.id,
+        })
+    return data
+
+def search_results_data(hits):
+    """RecycleView data for full-text search hits"""
+    if not hits:
+        return [{'text': 'No matching messages.', 'selectable': False, 'history_id': None}]
+    return [
+        {
+            'text': f"{hit.role}: {' '.join(hit.snippet.split())}",
+            'selectable': True,
+            'history_id': hit.history_id,
+        }
+        for hit in hits
+    ]
 
 class SelectableRecycleBoxLayout(FocusBehavior, LayoutSelectionBehavior, RecycleBoxLayout):
     """Adds selection and focus behavior to the RecycleView's BoxLayout"""
@@ -120,20 +148,17 @@ class SelectableLabel(RecycleDataViewBehavior, Label):
 
     def apply_selection(self, rv, index, is_selected):
         self.selected = is_selected
-        if is_selected:
-            app = App.get_running_app()
-            if index < len(app.saved_history_files):
-                conversation_path = app.saved_history_files[index]  # Retrieve the corresponding file path
-                app.load_conversation(conversation_path)  # Load the conversation
-            else:
-                logger.error(f"Invalid index {index} for saved_history_files with length {len(app.saved_history_files)}")
+        if is_selected and index < len(rv.data):
+            history_id = rv.data[index].get('history_id')
+            if history_id is not None:
+                App.get_running_app().load_conversation(history_id)  # Load the conversation
 
 class HistoryRecycleView(RecycleView):
     """RecycleView to display a list of saved conversations"""
 
-    def __init__(self, saved_history_files, **kwargs):
+    def __init__(self, saved_histories, **kwargs):
         super(HistoryRecycleView, self).__init__(**kwargs)
-        self.saved_history_files = saved_history_files  # Store the list of file paths
+        self.saved_histories = saved_histories  # Store the list of history index entries
 
         # Create and add the layout manager directly within the RecycleView
         self.layout_manager = SelectableRecycleBoxLayout(
@@ -149,15 +174,8 @@ class HistoryRecycleView(RecycleView):
         self.update_conversations_list()
 
     def update_conversations_list(self):
-        """Update the conversation list with the saved history files"""
-        if self.saved_history_files:
-            self.data = [{'text': 'Saved History', 'selectable': False}]
-            for file_path in self.saved_history_files:
-                file_name = os.path.basename(file_path).replace('.json', '')
-                self.data.append({'text': file_name})
-        else:
-            self.data = [{'text': 'No saved conversations found.', 'selectable': False}]
-        
+        """Update the conversation list with the saved history entries"""
+        self.data = history_list_data(self.saved_histories)
         self.refresh_from_data()
         logger.info("HistoryRecycleView updated with saved conversations.")
 
@@ -165,21 +183,209 @@ class HistoryRecycleView(RecycleView):
         """Update the default message when no saved conversations are found"""
         if message is None:
             message = 'No saved conversations found.'
-        self.data = [{'text': message, 'selectable': False}]
+        self.data = [{'text': message, 'selectable': False, 'history_id': None}]
         self.layout_manager.clear_selection()  # Clear any previous selection in the list
         self.refresh_from_data()  # Refresh the view to ensure the message is displayed
         logger.info("HistoryRecycleView updated with 'No Saved History' message.")
 
+# Avatar textures, decoded once and shared by every message row
+AVATARS = {True: ('images/human.png', (25, 27)), False: ('images/aichatbot25x26.png', (44, 44))}
+_avatar_textures = {}
+
+def avatar_texture(user):
+    """Cached texture of the user or bot avatar"""
+    texture = _avatar_textures.get(user)
+    if texture is None:
+        texture = _avatar_textures[user] = CoreImage(resource_path(AVATARS[user][0])).texture
+    return texture
+
+class MessageView(RecycleDataViewBehavior, BoxLayout):
+    """One row of the transcript, filled from its data dict and reused while scrolling"""
+
+    def __init__(self, **kwargs):
+        super(MessageView, self).__init__(orientation='horizontal', padding=10, spacing=10, **kwargs)
+        self.user = None
+        self.avatar = Image(size_hint=(None, None))
+        self.bubble = Label(size_hint=(None, None), valign='middle', padding=(10, 10))
+        self.spacer = Widget()  # Empty space on the side opposite to the avatar
+        with self.bubble.canvas.before:
+            self.bubble_color = Color(0.15, 0.27, 0.32, 1)
+            self.bubble_rect = RoundedRectangle(radius=[10,])
+        self.bubble.bind(pos=lambda instance, value: setattr(self.bubble_rect, 'pos', value),
+                         size=lambda instance, value: setattr(self.bubble_rect, 'size', value))
+
+    def refresh_view_attrs(self, rv, index, data):
+        user = data['user']
+        if user is not self.user:
+            self.user = user
+            self.clear_widgets()
+            if user:
+                self.add_widget(self.spacer)
+                self.add_widget(self.bubble)
+                self.add_widget(self.avatar)
+            else:
+                self.add_widget(self.avatar)
+                self.add_widget(self.bubble)
+                self.add_widget(self.spacer)
+            self.avatar.texture = avatar_texture(user)
+            self.avatar.size = AVATARS[user][1]
+            self.bubble.halign = 'right' if user else 'left'
+            self.bubble.color = (0.88, 0.95, 0.94, 1) if user else (0.93, 0.95, 0.96, 1)  # Softer text color
+            self.bubble_color.rgba = (0.16, 0.61, 0.56, 1) if user else (0.15, 0.27, 0.32, 1)  # Teal or slate gray
+        self.bubble.text = data['text']
+        self.bubble.text_size = (data['wrap_width'], None)
+        self.bubble.size = data['bubble_size']
+        # Size comes from 'view_size' through the layout, there are no other attributes to copy
+        return super(MessageView, self).refresh_view_attrs(rv, index, {})
+
+class LoadOlderView(RecycleDataViewBehavior, Button):
+    """First row of the transcript while older messages of a saved conversation are not loaded"""
+
+    def on_release(self):
+        App.get_running_app().load_older_messages()
+
+class TranscriptView(RecycleView):
+    """Chat transcript, only the visible rows exist as widgets
+
+    Row heights are measured once per message and wrap width with a core
+    label, without building any widget, and kept in the data.
+    """
+
+    def __init__(self, **kwargs):
+        super(TranscriptView, self).__init__(do_scroll_x=False, **kwargs)
+        self.layout_manager = RecycleBoxLayout(
+            default_size=(None, dp(56)),
+            default_size_hint=(1, None),
+            size_hint_y=None,
+            orientation='vertical',
+            spacing=10,
+            key_size='view_size',
+        )
+        self.layout_manager.bind(minimum_height=self.layout_manager.setter('height'))
+        self.add_widget(self.layout_manager)
+        self.viewclass = 'MessageView'
+        self.key_viewclass = 'viewclass'
+        self.wrap_width = None
+        self._heights = {}  # (text, wrap width) -> (bubble size, row height)
+        self._remeasure_trigger = Clock.create_trigger(self._remeasure, 0.2)
+        self.bind(width=lambda instance, value: self._remeasure_trigger())
+
+    def row(self, text, user, cache=True):
+        """Data of a message row"""
+        wrap_width = self._wrap_width()
+        bubble_size, height = self._measure(text, wrap_width, cache)
+        return {'text': text, 'user': user, 'wrap_width': wrap_width, 'bubble_size': bubble_size,
+                'view_size': (None, height)}
+
+    def append(self, text, user):
+        """Add a message at the bottom, return its row"""
+        row = self.row(text, user)
+        self.data.append(row)
+        Clock.schedule_once(self.scroll_to_end)
+        return row
+
+    def update(self, row, text, final=False):
+        """Replace the text of a row, e.g. a message still being streamed"""
+        # Partial texts are measured but not cached, only the final one is worth keeping
+        row.update(self.row(text, row['user'], cache=final))
+        for index in range(len(self.data) - 1, -1, -1):
+            if self.data[index] is row:
+                follow = self.scroll_y <= 0.01  # Keep following the bottom if the reader is there
+                self.data[index] = row
+                if follow:
+                    Clock.schedule_once(self.scroll_to_end)
+                return
+
+    def prepend(self, messages):
+        """Insert (text, user) rows on top, below the load older row, without moving the rows in view"""
+        at = 1 if self.data and self.data[0].get('viewclass') == 'LoadOlderView' else 0
+        distance = self.scroll_y * max(self._content_height() - self.height, 0)  # From the bottom
+        self.data[at:at] = [self.row(text, user) for text, user in messages]
+        scrollable = self._content_height() - self.height
+        if scrollable > 0:
+            Clock.schedule_once(lambda dt: setattr(self, 'scroll_y', min(distance / scrollable, 1)))
+
+    def set_load_older(self, text):
+        """Show the load older row with text, or remove it if text is None"""
+        has_row = bool(self.data) and self.data[0].get('viewclass') == 'LoadOlderView'
+        if text is None:
+            if has_row:
+                del self.data[0]
+        elif has_row:
+            self.data[0] = dict(self.data[0], text=text)
+        else:
+            self.data.insert(0, {'viewclass': 'LoadOlderView', 'text': text, 'view_size': (None, dp(40))})
+
+    def clear(self):
+        self.data = []
+        self._heights.clear()
+
+    def scroll_to_end(self, dt=None):
+        self.scroll_y = 0
+
+    def _wrap_width(self):
+        # Maximum width of 60% of the screen
+        return Window.width * 0.6
+
+    def _content_height(self):
+        heights = [row['view_size'][1] for row in self.data]
+        return sum(heights) + self.layout_manager.spacing * max(len(heights) - 1, 0)
+
+    def _measure(self, text, wrap_width, cache=True):
+        key = (text, wrap_width)
+        measured = self._heights.get(key)
+        if measured is None:
+            label = CoreLabel(text=text, text_size=(wrap_width, None), padding_x=10, padding_y=10)
+            label.refresh()
+            width, height = label.texture.size
+            bubble_size = (max(150, min(wrap_width, width + 20)), height + 20)
+            measured = (bubble_size, bubble_size[1] + 20)  # Adding padding to prevent overlap
+            if cache:
+                self._heights[key] = measured
+        return measured
+
+    def _remeasure(self, dt=None):
+        """Measure the rows again once the wrap width settled after a resize"""
+        wrap_width = self._wrap_width()
+        if wrap_width == self.wrap_width:
+            return
+        self.wrap_width = wrap_width
+        self._heights.clear()
+        # In place: a row being streamed is updated through the dict ChatApp holds
+        for row in self.data:
+            if not row.get('viewclass'):
+                row.update(self.row(row['text'], row['user']))
+        self.refresh_from_data()
+
+
 class ChatApp(App):
 
     def build(self):
-        # Initialize an event loop to be used for asyncio tasks
-        self.loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(self.loop)
+        # Ensure the saved history directory exists
+        logger.info(f"Saving histories in directory: {os.path.abspath(SAVE_DIR)}")
+        os.makedirs(SAVE_DIR, exist_ok=True)
+
+        # One event loop thread runs every request for the lifetime of the app
+        self.worker = LoopThread(name="duck_chat-gui").start()
+        self.requests = set()  # Futures of the questions in flight
+        # Questions share one conversation, they are answered one after the other
+        self.turn_lock = asyncio.Lock()
 
         # Initialize chat client and interface components
         self.chat_client = None
+        self.history_writer = HistoryWriter(flush_interval=None)
+
         self.selected_files = []  # Store selected files
+        self.history_pager = None  # Pages of the saved conversation on display
+        self.history_pager_start = None  # Position of the oldest message on display
+
+        # Streamed answers: chunks are queued by the response thread and drained once per frame,
+        # "" starts an answer and None ends it
+        self.stream_mode = True
+        self.stream_chunks = deque()
+        self.stream_row = None
+        self.stream_text = ""
+        self._stream_trigger = Clock.create_trigger(self._flush_stream)
 
         # Main layout with two panels: history and chat
         main_layout = BoxLayout(orientation='horizontal')  # Changed to horizontal to add a left panel
@@ -191,11 +397,22 @@ class ChatApp(App):
         history_label = Label(text="Saved History", size_hint_y=None, height=dp(40))
         left_panel.add_widget(history_label)
 
-        # Initialize the list of saved conversation files
-        self.saved_history_files = load_saved_conversations(SAVE_DIR)
+        # Full-text search over the saved conversations, run once typing pauses
+        self.history_search = TextInput(
+            hint_text="Search saved history",
+            size_hint_y=None,
+            height=dp(40),
+            multiline=False,
+        )
+        self._search_trigger = Clock.create_trigger(self.search_histories, 0.2)
+        self.history_search.bind(text=lambda instance, value: self._search_trigger())
+        left_panel.add_widget(self.history_search)
+
+        # Initialize the list of saved conversations from the history index
+        self.saved_histories = load_saved_conversations()
 
-        # Initialize HistoryRecycleView with the saved files
-        self.history_view = HistoryRecycleView(saved_history_files=self.saved_history_files, size_hint=(1, 1))
+        # Initialize HistoryRecycleView with the saved conversations
+        self.history_view = HistoryRecycleView(saved_histories=self.saved_histories, size_hint=(1, 1))
         left_panel.add_widget(self.history_view)
 
         main_layout.add_widget(left_panel)
@@ -241,13 +458,8 @@ class ChatApp(App):
     def setup_chat_interface(self):
         """Set up the chat interface components"""
 
-        # Chat display area
-        self.chat_display_layout = BoxLayout(orientation='vertical', size_hint_y=None, spacing=10)
-        self.chat_display_layout.bind(minimum_height=self.chat_display_layout.setter('height'))
-
-        self.chat_display = ScrollView(size_hint=(1, 1), do_scroll_x=False)
-        self.chat_display.add_widget(self.chat_display_layout)
-
+        # Chat display area, a RecycleView so long chats only hold the visible rows
+        self.chat_display = TranscriptView(size_hint=(1, 1))
         self.chat_layout.add_widget(self.chat_display)
 
         # User input area
@@ -293,20 +505,50 @@ class ChatApp(App):
             self.chat_layout.remove_widget(self.error_message_layout)
             del self.error_message_layout  # Clean up the reference to allow garbage collection
 
-    def load_conversation(self, conversation_path):
-        """Load a conversation from its file path"""
-        self.chat_display_layout.clear_widgets()
+    def load_conversation(self, history_id):
+        """Show the last messages of a saved conversation, older ones are paged in on demand"""
+        self.chat_display.clear()
+        self.history_pager = HistoryPager(history_id)
+        self.history_pager_start = None
+        self.worker.submit(asyncio.to_thread(self._load_page, self.history_pager, None))
+
+    def load_older_messages(self):
+        """Page in the messages before the ones on display"""
+        if self.history_pager is not None and self.history_pager_start:
+            self.chat_display.set_load_older("Loading...")
+            self.worker.submit(asyncio.to_thread(self._load_page, self.history_pager, self.history_pager_start))
+
+    def _load_page(self, pager, before):
+        """Read the page of messages preceding position before (the last page if None), off the UI thread"""
         try:
-            conv_id = os.path.basename(conversation_path).replace('history_', '').replace('.json', '')
-            saved_history = SavedHistory.load(conv_id)
-            for message in saved_history.messages:
-                user = message.role == Role.user
-                self.display_message(f"{'You' if user else 'AI'}: {message.content}", user=user)
-            logger.info(f"Loaded conversation from {conversation_path}")
-        except FileNotFoundError:
-            error_message = f"Error: Conversation file {conversation_path} not found."
-            self.display_message(error_message, user=False)
+            if before is None:
+                start, messages = pager.tail(HISTORY_PAGE_MESSAGES)
+            else:
+                start = max(before - HISTORY_PAGE_MESSAGES, 0)
+                messages = pager.page(start, before)
+        except (OSError, DuckChatException) as e:
+            error_message = f"Error: Conversation {pager.history_id} could not be loaded: {e}"
             logger.error(error_message)
+            Clock.schedule_once(lambda dt: self.display_message(error_message, user=False))
+            return
+        Clock.schedule_once(lambda dt: self._show_page(pager, start, messages, prepend=before is not None))
+
+    def _show_page(self, pager, start, messages, prepend):
+        """Display a page of a saved conversation"""
+        if pager is not self.history_pager:
+            return  # Another conversation was opened in the meantime
+        rows = [
+            (f"{'You' if message.role == Role.user else 'AI'}: {message.content}", message.role == Role.user)
+            for message in messages
+        ]
+        if prepend:
+            self.chat_display.prepend(rows)
+        else:
+            for text, user in rows:
+                self.chat_display.append(text, user)
+        self.history_pager_start = start
+        self.chat_display.set_load_older(f"Load older messages ({start} more)" if start > 0 else None)
+        logger.info(f"Showing messages {start} to {start + len(messages)} of conversation {pager.history_id}")
 
     def send_message(self, instance):
         """Send a message and handle the response"""
@@ -330,110 +572,80 @@ class ChatApp(App):
                 
                 self.user_input.text = ""
 
+                selected_files = self.selected_files
+
                 async def get_response():
                     try:
-                        # Add user's message and files to the history
-                        if message.strip():
-                            self.chat_client.saved_history.add_input(message)
-                        
-                        for file_path in self.selected_files:
-                            # Implement logic to read the file and process it
-                            with open(file_path, 'r') as f:
-                                file_content = f.read()  # This is an example for text files
-                            self.chat_client.saved_history.add_input(f"[FILE CONTENT]: {file_content}")
-                        
+                        async with self.turn_lock:
+                            await answer()
+                    except DuckChatException as e:
+                        if str(e) != "Session closed before completing the request.":
+                            self.display_message(f"Error: {str(e)}", user=False)
+
+                async def answer():
+                    # Add attached files to the history, ask_question records the message and answer
+                    for file_path in selected_files:
+                        # Implement logic to read the file and process it
+                        with open(file_path, 'r') as f:
+                            file_content = f.read()  # This is an example for text files
+                        self.chat_client.saved_history.add_input(f"[FILE CONTENT]: {file_content}")
+
+                    if self.stream_mode:
+                        # Tokens are shown as they arrive, the UI picks them up once per frame
+                        self.stream_chunks.append("")
+                        try:
+                            async for chunk in self.chat_client.ask_question_stream(message):
+                                self.stream_chunks.append(chunk)
+                                self._stream_trigger()
+                        finally:
+                            self.stream_chunks.append(None)
+                            self._stream_trigger()
+                    else:
                         # Get the response from the AI
                         response = await self.chat_client.ask_question(message)
-                        
-                        # Add AI's response to the history
-                        self.chat_client.saved_history.add_answer(response)
-                        
+
                         # Display the response
                         self.display_message(f"AI: {response}", user=False)
-                        
-                        # Save the history automatically after each interaction
-                        self.chat_client.saved_history.save()
 
-                    except DuckChatException as e:
-                        if str(e) != "Session closed before completing the request.":
-                            self.display_message(f"Error: {str(e)}", user=False)
+                    # The history is written off the loop once the answer is shown
+                    await self.history_writer.flush()
 
-                # Execute the async function in a separate thread
-                self.response_thread = threading.Thread(target=lambda: self.loop.run_until_complete(get_response()))
-                self.response_thread.start()
+                # Run it on the worker loop, several questions can be queued without blocking the UI
+                # The callback runs on the worker thread, the set is only touched on the UI thread
+                future = self.worker.submit(
+                    get_response(), callback=lambda f: Clock.schedule_once(lambda dt: self.requests.discard(f))
+                )
+                self.requests.add(future)
 
             # Clear selected files after sending
             self.selected_files = []
             self.update_selected_files_display()
 
+    def _flush_stream(self, dt=None):
+        """Show the chunks streamed since the last frame in the in-progress answer"""
+        while self.stream_chunks:
+            chunk = self.stream_chunks.popleft()
+            if chunk is None:
+                # End of the answer, its final size is worth caching
+                if self.stream_row is not None:
+                    self.chat_display.update(self.stream_row, self.stream_text, final=True)
+                self.stream_row = None
+                continue
+            if self.stream_row is None:
+                # Start of an answer, its bubble is created with the first token
+                self.stream_text = "AI: "
+                self.stream_row = self.chat_display.append(self.stream_text, user=False)
+            self.stream_text += chunk
+        if self.stream_row is not None:
+            self.chat_display.update(self.stream_row, self.stream_text)
+
     def display_message(self, message, user=False):
         """Display a message in the chat display area"""
         Clock.schedule_once(lambda dt: self._add_message_to_display(message, user))
 
     def _add_message_to_display(self, message, user):
         """Internal method to add a message to the chat display area"""
-        message_layout = BoxLayout(
-            orientation='horizontal', 
-            size_hint_y=None, 
-            padding=10, 
-            spacing=10
-        )
-
-        # Label for the message
-        label = Label(
-            text=message,
-            size_hint=(None, None),
-            text_size=(self.root.width * 0.6, None),  # Maximum width of 60% of the screen
-            halign='left' if not user else 'right',
-            valign='middle',
-            padding=(10, 10),
-            color=(0.93, 0.95, 0.96, 1) if not user else (0.88, 0.95, 0.94, 1)  # Softer text color
-        )
-
-        # Calculate the label's width and height based on content
-        label.texture_update()
-        label.width = max(150, min(self.root.width * 0.6, label.texture_size[0] + 20))
-        label.height = label.texture_size[1] + 20  # Dynamic height adjustment
-
-        # Background color with rounded corners and placement
-        with label.canvas.before:
-            if user:
-                Color(0.16, 0.61, 0.56, 1)  # Darker teal
-            else:
-                Color(0.15, 0.27, 0.32, 1)  # Dark slate gray
-
-            rect = RoundedRectangle(size=label.size, pos=label.pos, radius=[10,])
-            label.bind(pos=lambda instance, value: setattr(rect, 'pos', value),
-                    size=lambda instance, value: setattr(rect, 'size', value))
-
-        # Add the label and the image (either user or bot)
-        if user:
-            message_layout.add_widget(Widget())  # Empty space on the left for user messages
-            message_layout.add_widget(label)
-            message_layout.add_widget(Image(source=resource_path('images/human.png'), size_hint=(None, None), size=(25, 27)))
-        else:
-            message_layout.add_widget(Image(source=resource_path('images/aichatbot25x26.png'), size_hint=(None, None), size=(44, 44)))
-            message_layout.add_widget(label)
-            message_layout.add_widget(Widget())  # Empty space on the right for bot messages
-
-        # Set the size of the message_layout to ensure it fits the content properly
-        message_layout.height = label.height + 20  # Adding padding to prevent overlap
-
-        # Add the message layout to the chat display
-        self.chat_display_layout.add_widget(message_layout)
-        self.chat_display_layout.height += message_layout.height  # Increase layout height
-        self.chat_display.scroll_to(message_layout)
-
-        # Add animation here
-        self.animate_message(message_layout)
-
-    def animate_message(self, message_widget):
-        """Animate the appearance of a message"""
-        animation = Animation(size=(message_widget.width, 0), opacity=0, duration=0) + \
-                    Animation(size=(message_widget.width, message_widget.height), opacity=1, duration=0.3)
-
-        # Start the animation on the message widget
-        animation.start(message_widget)
+        self.chat_display.append(message, user)
 
     def animate_send_button(self):
         """Animate the send button when pressed"""
@@ -451,7 +663,8 @@ class ChatApp(App):
 
         try:
             model_type = ModelType[selected_model]
-            self.chat_client = DuckChat(model=model_type, session=aiohttp.ClientSession(loop=self.loop))
+            # The session belongs to the worker loop, create it there
+            self.chat_client = self.worker.run(self._create_chat_client(model_type))
             
             # Load history and update the history list
             self.update_history_list()
@@ -459,37 +672,36 @@ class ChatApp(App):
         except ValueError:
             self.show_error("Invalid model selected. Please select a valid model.")
 
+    async def _create_chat_client(self, model_type):
+        return DuckChat(model=model_type, session=aiohttp.ClientSession(), writer=self.history_writer)
+
+    def archive_histories(self, days):
+        """Move conversations untouched for days into the compressed archive, only on /archive"""
+        try:
+            count = SavedHistory.archive.pack(older_than=days * 24 * 3600)
+        except OSError as e:
+            logger.error(f"Failed to archive saved histories: {e}")
+            self.display_message(f"Failed to archive saved histories: {e}", user=False)
+            return
+        self.display_message(f"Archived {count} histories untouched for {days:g} days.", user=False)
+
+    def search_histories(self, dt=None):
+        """Show the saved messages matching the search box, or every history when it is empty"""
+        terms = self.history_search.text.strip()
+        if not terms:
+            self.history_view.update_conversations_list()
+            return
+        self.history_view.data = search_results_data(SavedHistory.index.search(terms))
+        self.history_view.refresh_from_data()
+
     def update_history_list(self):
         """Update the history list in the side panel"""
-        logger.info(f"Looking for conversation histories in: {SAVE_DIR}")
-        
         if self.chat_client:
-            # Appel à la fonction pour charger les fichiers d'historique
-            self.saved_history_files = load_saved_conversations(SAVE_DIR)
-            logger.info(f"Found history files: {self.saved_history_files}")
-            
-            # Initialize the data list with a header message
-            if self.saved_history_files:
-                self.history_view.data = [{'text': 'Saved History', 'selectable': False}]
-                logger.info("Appending 'Saved History' to the HistoryRecycleView.")
-                
-                # Add each history file to the list
-                for file_path in self.saved_history_files:
-                    file_name = os.path.basename(file_path).split('.')[0].replace('history_', '')
-                    logger.info(f"Adding {file_name} to history view")
-                    self.history_view.data.append({'text': file_name})
-                
-                logger.info(f"History list updated with {len(self.saved_history_files)} items.")
-            else:
-                # Display a message indicating no saved history
-                self.history_view.data = [{'text': 'No Saved History', 'selectable': False}]
-                logger.warning(f"No saved conversations found in the directory: {SAVE_DIR}")
-                logger.info("Appending 'No Saved History' to the HistoryRecycleView.")
-            
-            # Refresh the view to display the updated data
-            logger.info(f"Refreshing history view with data: {self.history_view.data}")
-            self.history_view.refresh_from_data()
-            logger.info("HistoryRecycleView refreshed.")
+            # The index answers without opening any history file
+            self.saved_histories = load_saved_conversations()
+            self.history_view.saved_histories = self.saved_histories
+            # Keep showing search results while a search is active
+            self.search_histories()
 
     def handle_command(self, command):
         """Handle custom slash commands"""
@@ -508,7 +720,11 @@ class ChatApp(App):
                 "- /retry [count]    : Regenerate the answer for the specified prompt (default /retry 1)\n"
                 "- /save             : Save the current conversation history\n"
                 "- /load [ID]        : Load a conversation history by ID\n"
-                "- /list_histories   : List all saved conversation histories\n"
+                "- /list_histories [page] : List saved conversation histories, newest first\n"
+                "- /search <terms>   : Search saved conversation histories\n"
+                "- /reindex          : Rebuild the saved history index from the history files\n"
+                f"- /archive [days]   : Pack histories untouched for days (default {ARCHIVE_AFTER_DAYS}) "
+                "into the compressed archive\n"
             )
             self.display_message(help_message, user=False)
         
@@ -523,14 +739,12 @@ class ChatApp(App):
             # self.INPUT_MODE = "multiline"
 
         elif command_name == "stream_on":
+            self.stream_mode = True
             self.display_message("Switched to stream mode", user=False)
-            # Activer le mode streaming
-            # self.STREAM_MODE = True
 
         elif command_name == "stream_off":
+            self.stream_mode = False
             self.display_message("Switched to non-stream mode", user=False)
-            # Désactiver le mode streaming
-            # self.STREAM_MODE = False
 
         elif command_name == "quit":
             self.display_message("Quitting application", user=False)
@@ -555,11 +769,18 @@ class ChatApp(App):
             # async logic could be implemented if needed
 
         elif command_name == "save":
-            try:
-                self.chat_client.saved_history.save()
-                self.display_message(f"History saved with ID: {self.chat_client.saved_history.id}", user=False)
-            except Exception as e:
-                self.display_message(f"Error saving history: {str(e)}", user=False)
+            # Saving goes through the writer on the worker loop, it may be writing this history already
+            saved_history = self.chat_client.saved_history
+
+            async def save():
+                try:
+                    self.history_writer.mark_dirty(saved_history)
+                    await self.history_writer.flush()
+                    self.display_message(f"History saved with ID: {saved_history.id}", user=False)
+                except Exception as e:
+                    self.display_message(f"Error saving history: {str(e)}", user=False)
+
+            self.worker.submit(save())
 
         elif command_name == "load":
             if len(args) < 2:
@@ -573,12 +794,38 @@ class ChatApp(App):
                     self.display_message(f"No history found with ID: {history_id}", user=False)
 
         elif command_name == "list_histories":
-            histories = glob.glob("history_*.json")
-            if not histories:
+            page = int(args[1]) if len(args) > 1 and args[1].isdigit() else 1
+            entries = SavedHistory.index.list(offset=(page - 1) * HISTORY_PAGE_SIZE, limit=HISTORY_PAGE_SIZE)
+            if not entries:
                 self.display_message("No histories found.", user=False)
             else:
-                history_list = "\n".join(histories)
-                self.display_message(f"Saved Histories:\n{history_list}", user=False)
+                history_list = "\n".join(
+                    f"{entry.id}  {entry.message_count} messages  {entry.preview}" for entry in entries
+                )
+                self.display_message(f"Saved Histories (page {page}):\n{history_list}", user=False)
+
+        elif command_name == "search":
+            terms = " ".join(args[1:])
+            hits = SavedHistory.index.search(terms) if terms else []
+            if not hits:
+                self.display_message("No matching messages.", user=False)
+            else:
+                results = "\n".join(f"{hit.history_id} #{hit.position} {hit.role}: {hit.snippet}" for hit in hits)
+                self.display_message(f"Search results:\n{results}", user=False)
+
+        elif command_name == "reindex":
+            count = SavedHistory.index.rebuild()
+            self.update_history_list()
+            self.display_message(f"Rebuilt history index with {count} histories.", user=False)
+
+        elif command_name == "archive":
+            try:
+                days = float(args[1]) if len(args) > 1 else ARCHIVE_AFTER_DAYS
+            except ValueError:
+                self.display_message("Invalid number of days.", user=False)
+                return
+            # Packing reads and compresses files, keep it off the UI thread
+            self.worker.submit(asyncio.to_thread(self.archive_histories, days))
 
         else:
             self.display_message(f"Unknown command: {command}. Type /help for available commands.", user=False)
@@ -586,14 +833,14 @@ class ChatApp(App):
 
     def on_stop(self):
         """This method is called when the application is closed"""
+        # Answers still on their way are discarded, partial ones included, finished turns are saved below
+        for future in list(self.requests):
+            future.cancel()
         if self.chat_client:
-            if hasattr(self, 'response_thread') and self.response_thread.is_alive():
-                # Wait for the response thread to finish
-                self.response_thread.join()
-            # Save the history one last time before closing
-            self.chat_client.saved_history.save()
-            self.loop.run_until_complete(self.chat_client.close_session())
-        self.loop.close()
+            # close_session flushes the history one last time
+            self.worker.run(self.chat_client.close_session())
+        self.worker.run(self.history_writer.close())
+        self.worker.stop()
 
     def open_file_chooser(self, instance):
         """Open the file chooser using MyWidget."""
@@ -0,0 +1,108 @@
+import asyncio
+import time
+from collections import Counter
+
+import msgspec
+
+from .api import DuckChat
+from .connection import ConnectionPool
+from .exceptions import DuckChatException
+from .metrics import MetricsRegistry
+from .models import ModelType
+from .models.models import scratch_histories
+from .ratelimit import RateLimiter
+
+
+class LoadReport(msgspec.Struct):
+    """Outcome of a load run, latencies in seconds"""
+    users: int
+    turns: int  # answered turns
+    errors: dict[str, int]  # exception name -> count
+    duration: float
+    tokens: int
+    latency: list[float]  # time from sending a question to the end of its answer
+    ttft: list[float]  # time from sending a question to its first token
+
+    @property
+    def tokens_per_second(self) -> float:
+        return self.tokens / self.duration if self.duration else 0.0
+
+    @property
+    def turns_per_second(self) -> float:
+        return self.turns / self.duration if self.duration else 0.0
+
+    def summary(self) -> str:
+        lines = [
+            f"{self.users} users, {self.turns} turns in {self.duration:.2f}s "
+            f"({self.turns_per_second:.1f} turns/s, {self.tokens_per_second:.0f} tokens/s)",
+        ]
+        for name, values in (("latency", self.latency), ("ttft", self.ttft)):
+            if values:
+                p50, p95, p99 = (percentile(values, q) * 1000 for q in (0.5, 0.95, 0.99))
+                lines.append(f"{name:<8} p50 {p50:8.1f} ms   p95 {p95:8.1f} ms   p99 {p99:8.1f} ms")
+        if self.errors:
+            lines.append("errors   " + ", ".join(f"{name} {count}" for name, count in sorted(self.errors.items())))
+        return "\n".join(lines)
+
+
+def percentile(values: list[float], q: float) -> float:
+    """Nearest-rank percentile, q between 0 and 1"""
+    ordered = sorted(values)
+    return ordered[min(max(int(q * len(ordered) + 0.5) - 1, 0), len(ordered) - 1)]
+
+
+async def run_load(
+    base_url: str,
+    users: int = 10,
+    turns: int = 5,
+    question: str = "Tell me something about ducks",
+    model: ModelType = ModelType.Claude,
+    rate: float | None = None,
+) -> LoadReport:
+    """Run ``users`` virtual users asking ``turns`` questions each, return the measures
+
+    Every user has its own DuckChat on one shared connection pool, the way
+    DuckChatPool runs conversations, and streams its answers with
+    ``ask_question_stream`` (a token is one SSE message event). ``rate``
+    caps the requests per second through a RateLimiter, None measures the
+    client and server alone.
+    """
+    limiter = RateLimiter(rate=rate, max_rate=rate) if rate else RateLimiter(rate=1e9, burst=users, max_rate=1e9)
+    latency: list[float] = []
+    ttft: list[float] = []
+    errors: Counter[str] = Counter()
+    tokens = 0
+
+    async def user(pool: ConnectionPool) -> None:
+        nonlocal tokens
+        chat = DuckChat(model, pool=pool, rate_limiter=limiter, metrics=MetricsRegistry(), base_url=base_url)
+        async with chat:
+            for _ in range(turns):
+                sent = time.perf_counter()
+                first = None
+                try:
+                    async for _ in chat.ask_question_stream(question):
+                        if first is None:
+                            first = time.perf_counter()
+                        tokens += 1
+                except DuckChatException as e:
+                    errors[type(e).__name__] += 1
+                    continue
+                latency.append(time.perf_counter() - sent)
+                if first is not None:
+                    ttft.append(first - sent)
+
+    with scratch_histories():
+        async with ConnectionPool(limit=users) as pool:
+            start = time.perf_counter()
+            await asyncio.gather(*(user(pool) for _ in range(users)))
+            duration = time.perf_counter() - start
+    return LoadReport(
+        users=users,
+        turns=len(latency),
+        errors=dict(errors),
+        duration=duration,
+        tokens=tokens,
+        latency=latency,
+        ttft=ttft,
+    )
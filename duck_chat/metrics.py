@@ -0,0 +1,183 @@
+import bisect
+import math
+from collections import defaultdict
+from typing import TYPE_CHECKING, Any
+
+if TYPE_CHECKING:
+    from aiohttp import web
+
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+RATE_BUCKETS = (1.0, 5.0, 10.0, 25.0, 50.0, 100.0, 250.0, 500.0, 1000.0, math.inf)
+SIZE_BUCKETS = (256.0, 1024.0, 4096.0, 16384.0, 65536.0, 262144.0, 1048576.0, math.inf)
+
+HISTOGRAMS = {
+    "request_latency_seconds": ("Time from sending /chat to the last chunk", LATENCY_BUCKETS),
+    "time_to_first_token_seconds": ("Time from sending /chat to the first answer token", LATENCY_BUCKETS),
+    "tokens_per_second": ("Answer tokens (SSE message events) per second", RATE_BUCKETS),
+    "chars_per_second": ("Answer characters per second", RATE_BUCKETS),
+    "request_bytes": ("Bytes sent to /chat per turn", SIZE_BUCKETS),
+    "context_saved_bytes": ("History bytes per turn not sent to /chat thanks to compaction", SIZE_BUCKETS),
+}
+COUNTERS = {
+    "requests": "Answered /chat requests",
+    "ratelimit": "429 rate limit answers",
+    "conversation_limit": "ERR_CONVERSATION_LIMIT answers",
+    "coalesced": "Requests answered by an identical request in flight",
+    "compactions": "Histories compacted to fit the context budget",
+}
+
+
+class Histogram:
+    """Fixed bucket histogram"""
+
+    def __init__(self, buckets: tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, counts: list[int], total: float, count: int) -> None:
+        """Add the observations of another histogram with the same buckets"""
+        if len(counts) != len(self.counts):
+            raise ValueError(f"Cannot merge a histogram of {len(counts)} buckets into one of {len(self.counts)}")
+        self.counts = [a + b for a, b in zip(self.counts, counts, strict=True)]
+        self.sum += total
+        self.count += count
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding quantile q"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts, strict=True):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+class MetricsRegistry:
+    """In-process counters and histograms broken down by model"""
+
+    def __init__(self, prefix: str = "duck_chat") -> None:
+        self.prefix = prefix
+        self.counters: dict[str, dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        self.histograms: dict[str, dict[str, Histogram]] = {name: {} for name in HISTOGRAMS}
+
+    def inc(self, name: str, model: str, value: float = 1) -> None:
+        self.counters[name][model] += value
+
+    def observe(self, name: str, model: str, value: float) -> None:
+        histograms = self.histograms[name]
+        histogram = histograms.get(model)
+        if histogram is None:
+            histogram = histograms[model] = Histogram(HISTOGRAMS[name][1])
+        histogram.observe(value)
+
+    def record_turn(self, model: str, latency: float, ttft: float | None, tokens: int, chars: int) -> None:
+        """Record one completed /chat answer"""
+        self.inc("requests", model)
+        self.observe("request_latency_seconds", model, latency)
+        if ttft is not None:
+            self.observe("time_to_first_token_seconds", model, ttft)
+            streaming = latency - ttft
+            if streaming > 0:
+                self.observe("tokens_per_second", model, tokens / streaming)
+                self.observe("chars_per_second", model, chars / streaming)
+
+    def snapshot(self) -> dict[str, Any]:
+        """Every metric as plain data, e.g. to send them from a worker process"""
+        return {
+            "counters": {name: dict(values) for name, values in self.counters.items()},
+            "histograms": {
+                name: {model: (h.counts, h.sum, h.count) for model, h in histograms.items()}
+                for name, histograms in self.histograms.items()
+            },
+        }
+
+    def merge(self, snapshot: dict[str, Any]) -> None:
+        """Add the metrics of another registry's snapshot() to this one"""
+        for name, values in snapshot["counters"].items():
+            for model, value in values.items():
+                self.inc(name, model, value)
+        for name, histograms in snapshot["histograms"].items():
+            for model, (counts, total, count) in histograms.items():
+                histogram = self.histograms[name].get(model)
+                if histogram is None:
+                    histogram = self.histograms[name][model] = Histogram(HISTOGRAMS[name][1])
+                histogram.merge(counts, total, count)
+
+    def models(self) -> list[str]:
+        names = {model for values in self.counters.values() for model in values}
+        names.update(model for values in self.histograms.values() for model in values)
+        return sorted(names)
+
+    def summary(self) -> str:
+        """Human readable report"""
+        models = self.models()
+        if not models:
+            return "No requests yet."
+        lines = []
+        for model in models:
+            lines.append(f"{model}:")
+            for name in COUNTERS:
+                lines.append(f"  {name:<28} {self.counters[name].get(model, 0):g}")
+            for name, histograms in self.histograms.items():
+                h = histograms.get(model)
+                if h is None:
+                    continue
+                lines.append(
+                    f"  {name:<28} mean={h.mean:.3g} p50<={h.quantile(0.5):g} "
+                    f"p95<={h.quantile(0.95):g} p99<={h.quantile(0.99):g} n={h.count}"
+                )
+        return "\n".join(lines)
+
+    def render_prometheus(self) -> str:
+        """Prometheus text exposition format"""
+        lines = []
+        for name, help_text in COUNTERS.items():
+            metric = f"{self.prefix}_{name}_total"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for model, value in sorted(self.counters[name].items()):
+                lines.append(f'{metric}{{model="{model}"}} {value:g}')
+        for name, (help_text, _) in HISTOGRAMS.items():
+            metric = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} histogram")
+            for model, h in sorted(self.histograms[name].items()):
+                cumulative = 0
+                for bound, count in zip(h.buckets, h.counts, strict=True):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else f"{bound:g}"
+                    lines.append(f'{metric}_bucket{{model="{model}",le="{le}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{model="{model}"}} {h.sum:g}')
+                lines.append(f'{metric}_count{{model="{model}"}} {h.count}')
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, port: int = 9464, host: str = "127.0.0.1") -> "web.AppRunner":
+        """Expose /metrics in Prometheus text format, cleanup the returned runner to stop"""
+        from aiohttp import web
+
+        async def handler(request: "web.Request") -> "web.Response":
+            return web.Response(text=self.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handler)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+REGISTRY = MetricsRegistry()
@@ -0,0 +1,178 @@
+import asyncio
+import itertools
+import logging
+import random
+import time
+import uuid
+from typing import Any, Self
+
+import msgspec
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ANSWER = (
+    "Sure! Here is a short answer so the client has a few tokens to stream. "
+    "The mock server splits it into words and sends them back as SSE message events, "
+    "exactly like the real /duckchat/v1/chat endpoint does."
+)
+
+
+class MockChatServer:
+    """Local stand-in for the DuckDuckGo chat API, to measure DuckChat offline
+
+    Serves ``/duckchat/v1/status`` and ``/duckchat/v1/chat`` on
+    ``host:port`` (port 0 picks a free one, see ``base_url``). Point a
+    DuckChat at it with ``DuckChat(base_url=server.base_url)``.
+
+    - ``rotate_vqd``: every /chat answer carries a new x-vqd-4 token and a
+      token is only accepted once, otherwise any issued token is accepted.
+    - ``chunk_tokens``: answer tokens (words) per SSE message event.
+    - ``token_delay``: seconds between events, ``first_token_delay`` before
+      the first one.
+    - ``ratelimit_rate`` / ``conversation_limit_rate``: probability for a
+      request to be answered with a 429, or a 429 ERR_CONVERSATION_LIMIT.
+      ``conversation_limit`` always refuses conversations with more user
+      messages than that.
+    """
+
+    def __init__(
+        self,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        answer: str = DEFAULT_ANSWER,
+        chunk_tokens: int = 1,
+        token_delay: float = 0.0,
+        first_token_delay: float = 0.0,
+        rotate_vqd: bool = True,
+        ratelimit_rate: float = 0.0,
+        conversation_limit_rate: float = 0.0,
+        conversation_limit: int | None = None,
+        seed: int | None = None,
+    ) -> None:
+        self.host = host
+        self.port = port
+        self.tokens = [word + " " for word in answer.split()]
+        self.chunk_tokens = chunk_tokens
+        self.token_delay = token_delay
+        self.first_token_delay = first_token_delay
+        self.rotate_vqd = rotate_vqd
+        self.ratelimit_rate = ratelimit_rate
+        self.conversation_limit_rate = conversation_limit_rate
+        self.conversation_limit = conversation_limit
+
+        self.status_requests = 0
+        self.chat_requests = 0
+        self.ratelimited = 0
+        self.conversation_limited = 0
+        self.invalid_vqd = 0
+
+        self._random = random.Random(seed)
+        self._vqd: set[str] = set()  # tokens the next /chat may use
+        self._ids = itertools.count()
+        self._encoder = msgspec.json.Encoder()
+        self._decoder = msgspec.json.Decoder()
+        self._runner: web.AppRunner | None = None
+
+    async def __aenter__(self) -> Self:
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.stop()
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/duckchat/v1/status", self.status)
+        app.router.add_post("/duckchat/v1/chat", self.chat)
+        return app
+
+    async def start(self) -> None:
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        # Resolve port 0 to the port actually bound
+        self.port = self._runner.addresses[0][1]
+        logger.info("Mock chat server listening on %s", self.base_url)
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def status(self, request: web.Request) -> web.Response:
+        self.status_requests += 1
+        if self._random.random() < self.ratelimit_rate:
+            self.ratelimited += 1
+            return self._error(429, "ERR_RATE_LIMIT")
+        if request.headers.get("x-vqd-accept") != "1":
+            return web.Response(status=200)
+        return web.Response(status=200, headers={"x-vqd-4": self._issue_vqd()})
+
+    async def chat(self, request: web.Request) -> web.StreamResponse:
+        self.chat_requests += 1
+        vqd = request.headers.get("x-vqd-4", "")
+        if vqd not in self._vqd:
+            self.invalid_vqd += 1
+            return self._error(400, "ERR_INVALID_VQD")
+        try:
+            body = self._decoder.decode(await request.read())
+            messages = body["messages"]
+            model = body["model"]
+        except (msgspec.DecodeError, KeyError, TypeError):
+            return self._error(400, "ERR_BAD_REQUEST")
+
+        if self._random.random() < self.ratelimit_rate:
+            self.ratelimited += 1
+            return self._error(429, "ERR_RATE_LIMIT")
+        turns = sum(message.get("role") == "user" for message in messages)
+        limited = self.conversation_limit is not None and turns > self.conversation_limit
+        if limited or self._random.random() < self.conversation_limit_rate:
+            self.conversation_limited += 1
+            return self._error(429, "ERR_CONVERSATION_LIMIT")
+
+        headers = {"Content-Type": "text/event-stream", "Cache-Control": "no-cache"}
+        if self.rotate_vqd:
+            self._vqd.discard(vqd)
+            headers["x-vqd-4"] = self._issue_vqd()
+        else:
+            headers["x-vqd-4"] = vqd
+        response = web.StreamResponse(status=200, headers=headers)
+        await response.prepare(request)
+
+        answer_id = f"chatcmpl-mock-{next(self._ids)}"
+        created = int(time.time())
+        if self.first_token_delay:
+            await asyncio.sleep(self.first_token_delay)
+        try:
+            for start in range(0, len(self.tokens), self.chunk_tokens):
+                if start and self.token_delay:
+                    await asyncio.sleep(self.token_delay)
+                event = {
+                    "role": "assistant",
+                    "message": "".join(self.tokens[start:start + self.chunk_tokens]),
+                    "created": created,
+                    "id": answer_id,
+                    "action": "success",
+                    "model": model,
+                }
+                await response.write(b"data: " + self._encoder.encode(event) + b"\n\n")
+            await response.write(b"data: [DONE]\n\n")
+            await response.write_eof()
+        except ConnectionResetError:
+            pass  # the client went away mid answer
+        return response
+
+    def _issue_vqd(self) -> str:
+        token = f"4-{uuid.uuid4().int}"
+        self._vqd.add(token)
+        return token
+
+    def _error(self, status: int, error_type: str) -> web.Response:
+        body = self._encoder.encode({"action": "error", "status": status, "type": error_type})
+        return web.Response(status=status, body=body, content_type="application/json")
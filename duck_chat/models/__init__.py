@@ -1,4 +1,18 @@
+from .archive import HistoryArchive
+from .index import HistoryEntry, HistoryIndex, SearchHit
 from .model_type import ModelType
 from .models import History, Message, Role, SavedHistory
+from .pager import HistoryPager
 
-__all__ = ["History", "ModelType", "Message", "Role"]
+__all__ = [
+    "History",
+    "HistoryArchive",
+    "HistoryEntry",
+    "HistoryIndex",
+    "HistoryPager",
+    "ModelType",
+    "Message",
+    "Role",
+    "SavedHistory",
+    "SearchHit",
+]
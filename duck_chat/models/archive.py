@@ -0,0 +1,288 @@
+import functools
+import gzip
+import logging
+import os
+import threading
+import time
+
+import msgspec
+
+try:
+    import zstandard
+except ImportError:  # optional, segments fall back to gzip
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Segment suffix -> (compress, decompress), every history is compressed on its own
+CODECS = {".gz": (functools.partial(gzip.compress, compresslevel=6), gzip.decompress)}
+if zstandard is not None:
+    CODECS[".zst"] = (zstandard.ZstdCompressor(level=10).compress, zstandard.ZstdDecompressor().decompress)
+
+
+class ArchivedEntry(msgspec.Struct, array_like=True):
+    """Where one history sits in a segment"""
+    offset: int
+    length: int
+    updated: float  # modification time of the history when it was archived
+
+
+class HistoryArchive:
+    """Cold histories packed into compressed, append-once segment files
+
+    ``pack()`` moves histories not modified for a while out of the history
+    directory into ``segment_NNNNNN.<gz|zst>`` files. Each segment has a
+    ``.idx`` sidecar mapping history ids to the offset and length of their
+    compressed log, so ``read()`` costs one seek and one small read.
+    ``enforce_retention()`` drops whole segments past an age or total size.
+
+    ``SavedHistory.load()`` falls back to the archive, so callers do not
+    need to know where a history lives. Saving an archived history writes a
+    new live log, which shadows the archived copy.
+    """
+
+    def __init__(self, directory: str, segment_bytes: int = 16 * 1024 * 1024, codec: str | None = None) -> None:
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.codec = codec or (".zst" if ".zst" in CODECS else ".gz")
+        if self.codec not in CODECS:
+            raise ValueError(f"Unknown archive codec {self.codec!r}, use one of {sorted(CODECS)}")
+
+        self._segments: dict[str, dict[str, ArchivedEntry]] | None = None  # segment path -> entries, oldest first
+        self._locations: dict[str, str] = {}  # history id -> path of the newest segment holding it
+        self._lock = threading.RLock()
+        self._encoder = msgspec.json.Encoder()
+        self._decoder = msgspec.json.Decoder(dict[str, ArchivedEntry])
+
+    def __contains__(self, history_id: str) -> bool:
+        with self._lock:
+            self._segment_index()
+            return history_id in self._locations
+
+    def ids(self) -> list[str]:
+        with self._lock:
+            self._segment_index()
+            return list(self._locations)
+
+    def get(self, history_id: str) -> ArchivedEntry | None:
+        with self._lock:
+            segments = self._segment_index()
+            segment = self._locations.get(history_id)
+            return segments[segment][history_id] if segment is not None else None
+
+    @property
+    def size(self) -> int:
+        """Bytes used by the segments"""
+        with self._lock:
+            return sum(self._segment_size(segment) for segment in self._segment_index())
+
+    def read(self, history_id: str) -> bytes | None:
+        """Uncompressed log of an archived history, None if it is not archived"""
+        with self._lock:
+            segments = self._segment_index()
+            segment = self._locations.get(history_id)
+            if segment is None:
+                return None
+            entry = segments[segment][history_id]
+        with open(segment, 'rb') as f:
+            f.seek(entry.offset)
+            data = f.read(entry.length)
+        return CODECS[os.path.splitext(segment)[1]][1](data)
+
+    def pack(self, older_than: float) -> int:
+        """Archive histories not modified for ``older_than`` seconds, return how many"""
+        from .models import HISTORY_SUFFIXES, SavedHistory
+
+        history_dir = os.path.dirname(self.directory)
+        if not os.path.isdir(history_dir):
+            return 0
+        files: dict[str, list[tuple[str, float]]] = {}
+        with os.scandir(history_dir) as it:
+            for f in it:
+                if not f.name.startswith("history_"):
+                    continue
+                history_id, ext = os.path.splitext(f.name[len("history_"):])
+                if ext in HISTORY_SUFFIXES:
+                    files.setdefault(history_id, []).append((f.path, f.stat().st_mtime))
+        cutoff = time.time() - older_than
+        cold = sorted(
+            (max(mtime for _, mtime in paths), history_id, paths)
+            for history_id, paths in files.items()
+            if all(mtime < cutoff for _, mtime in paths)
+        )
+        if not cold:
+            return 0
+
+        compress = CODECS[self.codec][0]
+        packed = 0
+        with self._lock:
+            self._segment_index()
+            os.makedirs(self.directory, exist_ok=True)
+            segment = None
+            for updated, history_id, paths in cold:
+                try:
+                    data = compress(SavedHistory.load(history_id).to_log())
+                except Exception as e:
+                    logger.warning("Not archiving unreadable history %s: %s", history_id, e)
+                    continue
+                if segment is None:
+                    segment = _SegmentWriter(self._next_segment_path())
+                segment.add(history_id, data, updated, paths)
+                packed += 1
+                if segment.size >= self.segment_bytes:
+                    self._finish(segment)
+                    segment = None
+            if segment is not None:
+                self._finish(segment)
+        logger.info("Archived %d histories", packed)
+        return packed
+
+    def enforce_retention(self, max_age: float | None = None, max_bytes: int | None = None) -> int:
+        """Drop segments whose newest history is older than ``max_age`` seconds, then
+        the oldest segments until the archive fits in ``max_bytes``
+
+        Returns how many histories were deleted for good.
+        """
+        with self._lock:
+            segments = self._segment_index()
+            dropped = []
+            if max_age is not None:
+                cutoff = time.time() - max_age
+                for segment, entries in segments.items():
+                    if max((entry.updated for entry in entries.values()), default=0) < cutoff:
+                        dropped.append(segment)
+            if max_bytes is not None:
+                size = sum(self._segment_size(segment) for segment in segments if segment not in dropped)
+                for segment in segments:
+                    if size <= max_bytes:
+                        break
+                    if segment not in dropped:
+                        size -= self._segment_size(segment)
+                        dropped.append(segment)
+            if not dropped:
+                return 0
+
+            ids = set()
+            for segment in dropped:
+                ids.update(segments.pop(segment))
+                for path in (segment, f"{segment}.idx"):
+                    try:
+                        os.remove(path)
+                    except OSError as e:
+                        logger.warning("Failed to remove archive segment %s: %s", path, e)
+            self._locate()
+            gone = [history_id for history_id in ids if history_id not in self._locations]
+        deleted = self._forget(gone)
+        logger.info("Dropped %d archive segments, %d histories deleted", len(dropped), deleted)
+        return deleted
+
+    def _forget(self, history_ids: list[str]) -> int:
+        """Remove histories gone from the archive from the index, unless they are live again"""
+        from .models import HISTORY_SUFFIXES, SavedHistory
+
+        history_dir = os.path.dirname(self.directory)
+        deleted = 0
+        for history_id in history_ids:
+            # A live log written since the history was archived keeps it
+            live = any(
+                os.path.exists(os.path.join(history_dir, f"history_{history_id}{suffix}"))
+                for suffix in HISTORY_SUFFIXES
+            )
+            if not live:
+                deleted += 1
+                if SavedHistory.index is not None:
+                    SavedHistory.index.remove(history_id)
+        return deleted
+
+    def _finish(self, segment: '_SegmentWriter') -> None:
+        """Make a written segment durable and visible, then remove the histories it holds"""
+        segment.close()
+        sidecar = f"{segment.path}.idx"
+        with open(f"{sidecar}.tmp", 'wb') as f:
+            f.write(self._encoder.encode(segment.entries))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{sidecar}.tmp", sidecar)
+        self._segments[segment.path] = segment.entries
+        for history_id in segment.entries:
+            self._locations[history_id] = segment.path
+
+        for paths in segment.sources.values():
+            removed = 0
+            for path, mtime in paths:
+                try:
+                    # Saved again while it was being packed, the live log wins
+                    if os.path.getmtime(path) == mtime:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    pass
+            if removed == len(paths):
+                try:
+                    os.remove(f"{os.path.splitext(paths[0][0])[0]}.idx")  # message offsets of the log
+                except OSError:
+                    pass
+
+    def _next_segment_path(self) -> str:
+        numbers = [0]
+        for name in os.listdir(self.directory):
+            if name.startswith("segment_"):
+                number = name[len("segment_"):].split(".", 1)[0]
+                if number.isdigit():
+                    numbers.append(int(number))
+        return os.path.join(self.directory, f"segment_{max(numbers) + 1:06d}{self.codec}")
+
+    def _segment_size(self, segment: str) -> int:
+        try:
+            return os.path.getsize(segment) + os.path.getsize(f"{segment}.idx")
+        except OSError:
+            return 0
+
+    def _segment_index(self) -> dict[str, dict[str, ArchivedEntry]]:
+        """Entries of every segment, read from the sidecars once"""
+        if self._segments is None:
+            self._segments = {}
+            if os.path.isdir(self.directory):
+                # A segment without its sidecar was interrupted before completion and is ignored
+                for name in sorted(os.listdir(self.directory)):
+                    if not name.endswith(".idx"):
+                        continue
+                    segment = os.path.join(self.directory, name[:-len(".idx")])
+                    if os.path.splitext(segment)[1] not in CODECS:
+                        logger.warning("Skipping archive segment %s, its codec is not available", segment)
+                        continue
+                    try:
+                        with open(os.path.join(self.directory, name), 'rb') as f:
+                            self._segments[segment] = self._decoder.decode(f.read())
+                    except (OSError, msgspec.DecodeError) as e:
+                        logger.warning("Skipping unreadable archive index %s: %s", name, e)
+            self._locate()
+        return self._segments
+
+    def _locate(self) -> None:
+        self._locations = {}
+        for segment, entries in self._segments.items():
+            for history_id in entries:
+                self._locations[history_id] = segment
+
+
+class _SegmentWriter:
+    """Segment file being written by one ``pack()``"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.entries: dict[str, ArchivedEntry] = {}
+        self.sources: dict[str, list[tuple[str, float]]] = {}
+        self.size = 0
+        self._file = open(path, 'wb')
+
+    def add(self, history_id: str, data: bytes, updated: float, paths: list[tuple[str, float]]) -> None:
+        self._file.write(data)
+        self.entries[history_id] = ArchivedEntry(self.size, len(data), updated)
+        self.sources[history_id] = paths
+        self.size += len(data)
+
+    def close(self) -> None:
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._file.close()
@@ -0,0 +1,292 @@
+import glob
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable
+
+import msgspec
+
+logger = logging.getLogger(__name__)
+
+SORT_COLUMNS = {"updated", "created", "message_count", "byte_size", "model", "id"}
+
+# Bump when the schema changes, older databases are rebuilt from the history files
+SCHEMA_VERSION = 2
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS histories (
+    id TEXT PRIMARY KEY,
+    model TEXT NOT NULL,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    message_count INTEGER NOT NULL,
+    byte_size INTEGER NOT NULL,
+    preview TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS histories_updated ON histories (updated);
+CREATE INDEX IF NOT EXISTS histories_created ON histories (created);
+
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    history_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL
+);
+CREATE UNIQUE INDEX IF NOT EXISTS messages_position ON messages (history_id, position);
+
+-- Inverted index over the messages table, kept in sync by the triggers below
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (
+    content, content='messages', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS messages_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, content) VALUES (new.id, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, content) VALUES ('delete', old.id, old.content);
+END;
+"""
+
+
+class HistoryEntry(msgspec.Struct):
+    """Metadata of one saved history"""
+    id: str
+    model: str
+    created: float
+    updated: float
+    message_count: int
+    byte_size: int
+    preview: str
+
+
+class SearchHit(msgspec.Struct):
+    """One message matching a search, best matches have the lowest rank"""
+    history_id: str
+    position: int
+    role: str
+    snippet: str
+    rank: float
+    preview: str
+
+
+def match_query(terms: str) -> str:
+    """FTS5 query matching messages that contain every term
+
+    Terms are quoted so user input never hits the FTS5 query syntax, the
+    last one also matches as a prefix to support search as you type.
+    """
+    words = ['"' + word.replace('"', '""') + '"' for word in terms.split()]
+    if words:
+        words[-1] += "*"
+    return " ".join(words)
+
+
+class HistoryIndex:
+    """SQLite index of saved histories, so listing never parses history files
+
+    Holds the metadata of every history and an FTS5 full-text index of its
+    messages. Kept up to date by ``SavedHistory.save()``, which only sends
+    the messages changed since the previous save. If the database file is
+    missing or from an older version it is rebuilt from the history files on
+    first use, ``rebuild()`` does the same on demand.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._connection: sqlite3.Connection | None = None
+        # Saves may come from the HistoryWriter thread
+        self._lock = threading.RLock()
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        if self._connection is None:
+            with self._lock:
+                if self._connection is None:
+                    self._connection = self._connect()
+        return self._connection
+
+    def _connect(self) -> sqlite3.Connection:
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # One small transaction per save, do not fsync each of them
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(SCHEMA)
+        if connection.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+            self._rebuild(connection, directory)
+            connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        return connection
+
+    def record(
+        self,
+        history_id: str,
+        model: str,
+        message_count: int,
+        byte_size: int,
+        preview: str,
+        updated: float | None = None,
+        first_position: int = 0,
+        messages: Iterable[tuple[str, str]] = (),
+    ) -> None:
+        """Insert or update the entry of a saved history
+
+        Messages from ``first_position`` on are replaced by ``messages``, as
+        (role, content) pairs, earlier ones stay indexed as they are.
+        """
+        updated = updated or time.time()
+        with self._lock, self.connection as connection:
+            connection.execute(
+                "INSERT INTO histories (id, model, created, updated, message_count, byte_size, preview) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (id) DO UPDATE SET model = excluded.model, updated = excluded.updated, "
+                "message_count = excluded.message_count, byte_size = excluded.byte_size, preview = excluded.preview",
+                (history_id, model, updated, updated, message_count, byte_size, preview),
+            )
+            connection.execute(
+                "DELETE FROM messages WHERE history_id = ? AND position >= ?", (history_id, first_position)
+            )
+            connection.executemany(
+                "INSERT INTO messages (history_id, position, role, content) VALUES (?, ?, ?, ?)",
+                (
+                    (history_id, position, role, content)
+                    for position, (role, content) in enumerate(messages, first_position)
+                ),
+            )
+
+    def remove(self, history_id: str) -> None:
+        with self._lock, self.connection as connection:
+            connection.execute("DELETE FROM histories WHERE id = ?", (history_id,))
+            connection.execute("DELETE FROM messages WHERE history_id = ?", (history_id,))
+
+    def get(self, history_id: str) -> HistoryEntry | None:
+        with self._lock:
+            row = self.connection.execute("SELECT * FROM histories WHERE id = ?", (history_id,)).fetchone()
+        return HistoryEntry(*row) if row else None
+
+    def count(self) -> int:
+        with self._lock:
+            return self.connection.execute("SELECT COUNT(*) FROM histories").fetchone()[0]
+
+    def search(self, terms: str, limit: int = 20, highlight: tuple[str, str] = ("[", "]")) -> list[SearchHit]:
+        """Messages containing every term, best match first
+
+        Snippets surround the matched words with ``highlight``.
+        """
+        query = match_query(terms)
+        if not query:
+            return []
+        start, end = highlight
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT m.history_id, m.position, m.role, snippet(messages_fts, 0, ?, ?, '...', 16), "
+                "messages_fts.rank, coalesce(h.preview, '') "
+                "FROM messages_fts "
+                "JOIN messages AS m ON m.id = messages_fts.rowid "
+                "LEFT JOIN histories AS h ON h.id = m.history_id "
+                "WHERE messages_fts MATCH ? ORDER BY messages_fts.rank LIMIT ?",
+                (start, end, query, limit),
+            ).fetchall()
+        return [SearchHit(*row) for row in rows]
+
+    def list(
+        self,
+        offset: int = 0,
+        limit: int = 50,
+        sort: str = "updated",
+        descending: bool = True,
+    ) -> list[HistoryEntry]:
+        """One page of entries"""
+        if sort not in SORT_COLUMNS:
+            raise ValueError(f"Cannot sort histories by {sort!r}, use one of {sorted(SORT_COLUMNS)}")
+        order = "DESC" if descending else "ASC"
+        with self._lock:
+            rows = self.connection.execute(
+                f"SELECT * FROM histories ORDER BY {sort} {order}, id LIMIT ? OFFSET ?", (limit, offset)
+            ).fetchall()
+        return [HistoryEntry(*row) for row in rows]
+
+    def rebuild(self) -> int:
+        """Re-create the index from the history files, return the number of entries"""
+        with self._lock:
+            return self._rebuild(self.connection, os.path.dirname(self.path))
+
+    def _rebuild(self, connection: sqlite3.Connection, directory: str) -> int:
+        from .models import HISTORY_SUFFIXES, SavedHistory
+
+        rows = []
+        messages = []
+        seen = set()
+        paths = glob.glob(os.path.join(directory, "history_*"))
+        for path in paths:
+            name = os.path.basename(path)
+            history_id, ext = os.path.splitext(name[len("history_"):])
+            # Several files exist while a history is being migrated, load() picks the right one
+            if ext not in HISTORY_SUFFIXES or history_id in seen:
+                continue
+            seen.add(history_id)
+            try:
+                history = SavedHistory.load(history_id)
+            except Exception as e:
+                logger.warning("Skipping unreadable history %s: %s", path, e)
+                continue
+            stat = os.stat(path)
+            rows.append(
+                (
+                    history.id,
+                    history.model.name,
+                    stat.st_mtime,
+                    stat.st_mtime,
+                    len(history.messages),
+                    stat.st_size,
+                    history.preview,
+                )
+            )
+            messages.extend(
+                (history.id, position, message.role.value, message.content)
+                for position, message in enumerate(history.messages)
+            )
+        archive = SavedHistory.archive
+        for history_id in archive.ids() if archive is not None else ():
+            if history_id in seen:
+                continue
+            entry = archive.get(history_id)
+            try:
+                history = SavedHistory.load(history_id)
+            except Exception as e:
+                logger.warning("Skipping unreadable archived history %s: %s", history_id, e)
+                continue
+            rows.append(
+                (
+                    history.id,
+                    history.model.name,
+                    entry.updated,
+                    entry.updated,
+                    len(history.messages),
+                    entry.length,
+                    history.preview,
+                )
+            )
+            messages.extend(
+                (history.id, position, message.role.value, message.content)
+                for position, message in enumerate(history.messages)
+            )
+        with connection:
+            connection.execute("DELETE FROM histories")
+            connection.execute("DELETE FROM messages")
+            connection.executemany("INSERT INTO histories VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            connection.executemany(
+                "INSERT INTO messages (history_id, position, role, content) VALUES (?, ?, ?, ?)", messages
+            )
+            # Whatever state the full-text index was in, regenerate it from the messages
+            connection.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+        logger.info("Rebuilt history index with %d entries", len(rows))
+        return len(rows)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
@@ -1,10 +1,20 @@
+import contextlib
+from abc import ABC, abstractmethod
 from enum import Enum
+from typing import ClassVar, Iterator
 from uuid import uuid4
 from .model_type import ModelType
 import msgspec
 import os
-import json
+import logging
+import sqlite3
+import struct
+import tempfile
 from ..exceptions import DuckChatException
+from .archive import HistoryArchive
+from .index import HistoryIndex
+
+logger = logging.getLogger(__name__)
 
 class Role(Enum):
     user = "user"
@@ -38,11 +48,300 @@ class History(msgspec.Struct):
         
 
 
-class SavedHistory:
-    def __init__(self, model: ModelType, messages: list[Message] = None, history_id: str = None):
-        self.id = history_id or str(uuid4())
-        self.model = model
-        self.messages = messages or []
+SAVE_DIR = os.path.join(os.path.dirname(__file__), '..', '..', 'savedhistory')
+
+
+class LogRecord(msgspec.Struct, omit_defaults=True):
+    """One record of a conversation log: header, message or truncation"""
+    id: str | None = None
+    model: ModelType | None = None
+    role: Role | None = None
+    content: str = ""
+    truncate: int | None = None
+
+
+class LogFormat(ABC):
+    """How the records of a conversation log are framed on disk"""
+    name: str
+    suffix: str
+
+    @abstractmethod
+    def encode(self, record: msgspec.Struct) -> bytes:
+        """One framed record"""
+
+    @abstractmethod
+    def decode(self, data: bytes) -> tuple[list[LogRecord], bool]:
+        """Every complete record, and whether the log ends with a torn write"""
+
+    @abstractmethod
+    def decode_at(self, data: bytes, offset: int) -> LogRecord:
+        """The record starting at offset"""
+
+    @abstractmethod
+    def offsets(self, data: bytes) -> list[int]:
+        """Offset of every complete record"""
+
+
+class JsonLinesFormat(LogFormat):
+    """One compact JSON document per line"""
+    name = "json"
+    suffix = ".jsonl"
+
+    def __init__(self) -> None:
+        self._encoder = msgspec.json.Encoder()
+        self._decoder = msgspec.json.Decoder(LogRecord)
+
+    def encode(self, record: msgspec.Struct) -> bytes:
+        return self._encoder.encode(record) + b"\n"
+
+    def decode_at(self, data: bytes, offset: int) -> LogRecord:
+        end = data.find(b"\n", offset)
+        return self._decoder.decode(data[offset:end if end != -1 else len(data)])
+
+    def offsets(self, data: bytes) -> list[int]:
+        offsets = []
+        offset = 0
+        while True:
+            end = data.find(b"\n", offset)
+            if end == -1:
+                return offsets
+            if end > offset:
+                offsets.append(offset)
+            offset = end + 1
+
+    def decode(self, data: bytes) -> tuple[list[LogRecord], bool]:
+        try:
+            return self._decoder.decode_lines(data), False
+        except msgspec.DecodeError:
+            pass
+        # Torn last write, keep what was fully written
+        records = []
+        for line in data.splitlines():
+            if not line:
+                continue
+            try:
+                records.append(self._decoder.decode(line))
+            except msgspec.DecodeError:
+                return records, True
+        return records, False
+
+
+FRAME_LENGTH = struct.Struct(">I")
+
+
+class MsgpackFormat(LogFormat):
+    """MessagePack records, each prefixed with its 4 byte big-endian length"""
+    name = "msgpack"
+    suffix = ".msgpack"
+
+    def __init__(self) -> None:
+        self._encoder = msgspec.msgpack.Encoder()
+        self._decoder = msgspec.msgpack.Decoder(LogRecord)
+        self._array_decoder = msgspec.msgpack.Decoder(list[LogRecord])
+
+    def encode(self, record: msgspec.Struct) -> bytes:
+        payload = self._encoder.encode(record)
+        return FRAME_LENGTH.pack(len(payload)) + payload
+
+    def decode_at(self, data: bytes, offset: int) -> LogRecord:
+        start = offset + 4
+        return self._decoder.decode(data[start:start + FRAME_LENGTH.unpack_from(data, offset)[0]])
+
+    def offsets(self, data: bytes) -> list[int]:
+        offsets = []
+        offset = 0
+        while offset + 4 <= len(data):
+            end = offset + 4 + FRAME_LENGTH.unpack_from(data, offset)[0]
+            if end > len(data):
+                break
+            offsets.append(offset)
+            offset = end
+        return offsets
+
+    def decode(self, data: bytes) -> tuple[list[LogRecord], bool]:
+        view = memoryview(data)
+        unpack_length = FRAME_LENGTH.unpack_from
+        frames = []
+        offset = 0
+        while offset + 4 <= len(data):
+            start = offset + 4
+            end = start + unpack_length(data, offset)[0]
+            if end > len(data):
+                break
+            frames.append(view[start:end])
+            offset = end
+        torn = offset != len(data)
+        # Decode every record in one call, as a MessagePack array of them
+        array = b"\xdd" + len(frames).to_bytes(4, "big") + b"".join(frames)
+        try:
+            return self._array_decoder.decode(array), torn
+        except msgspec.DecodeError:
+            pass
+        # A frame of garbage, keep the records before it
+        records = []
+        for frame in frames:
+            try:
+                records.append(self._decoder.decode(frame))
+            except msgspec.DecodeError:
+                return records, True
+        return records, torn
+
+
+LOG_FORMATS: dict[str, LogFormat] = {fmt.name: fmt for fmt in (JsonLinesFormat(), MsgpackFormat())}
+
+# Suffixes of history files, the legacy single JSON document last
+HISTORY_SUFFIXES = tuple(fmt.suffix for fmt in LOG_FORMATS.values()) + (".json",)
+
+
+def sniff_format(data: bytes) -> LogFormat:
+    """Format of a log from its first byte, a JSON header always starts with '{'"""
+    return LOG_FORMATS["json"] if data[:1] == b"{" else LOG_FORMATS["msgpack"]
+
+
+# Entries of the message offset index: the log size it covers, then one log offset per message
+OFFSET = struct.Struct("<Q")
+
+
+def offsets_path(log_path: str) -> str:
+    """Message offset index of a log"""
+    return f"{os.path.splitext(log_path)[0]}.idx"
+
+
+def record_offsets(records: list[bytes], start: int = 0) -> list[int]:
+    """Where each of the framed records starts once joined after start bytes"""
+    offsets = []
+    for record in records:
+        offsets.append(start)
+        start += len(record)
+    return offsets
+
+
+class PendingWrite(msgspec.Struct):
+    """Bytes one save has to put on disk, and the index entry to refresh"""
+    path: str
+    data: bytes
+    append: bool
+    history_id: str
+    model: str
+    message_count: int
+    preview: str
+    first_position: int  # messages from here on are re-indexed
+    messages: list[tuple[str, str]]  # (role, content) of those messages
+    offsets: list[int]  # where the records of those messages start in data
+    obsolete: list[str] = []  # files the new log replaces
+
+    def write(self) -> None:
+        """Append to the log, or replace it atomically through a temp file"""
+        if self.append:
+            # Appending to a missing log would lose its header, fail and let the caller rewrite it
+            if not os.path.exists(self.path):
+                raise FileNotFoundError(self.path)
+            with open(self.path, 'ab') as f:
+                base = f.tell()
+                f.write(self.data)
+                size = f.tell()
+        else:
+            base = 0
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(self.data)
+            os.replace(tmp_path, self.path)
+            size = len(self.data)
+            for path in self.obsolete:
+                if os.path.exists(path):
+                    os.remove(path)
+
+        self._write_offsets(base, size)
+
+        if SavedHistory.index is not None:
+            try:
+                SavedHistory.index.record(
+                    self.history_id,
+                    self.model,
+                    self.message_count,
+                    size,
+                    self.preview,
+                    first_position=self.first_position,
+                    messages=self.messages,
+                )
+            except sqlite3.Error as e:
+                # The history itself is safe on disk, the index can be rebuilt
+                logger.error("Failed to index history %s: %s", self.history_id, e)
+
+    def _write_offsets(self, base: int, size: int) -> None:
+        """Bring the message offset index of the log in step with it
+
+        The index starts with the log size it describes, readers rebuild it
+        when that does not match, so a failure here only costs one rebuild.
+        """
+        path = offsets_path(self.path)
+        entries = struct.pack(f"<{len(self.offsets)}Q", *(base + offset for offset in self.offsets))
+        try:
+            if self.append:
+                with open(path, 'r+b') as f:
+                    if OFFSET.unpack(f.read(OFFSET.size))[0] != base:
+                        return  # already stale
+                    f.seek(OFFSET.size * (1 + self.first_position))
+                    f.write(entries)
+                    f.truncate()
+                    f.seek(0)
+                    f.write(OFFSET.pack(size))
+            else:
+                with open(f"{path}.tmp", 'wb') as f:
+                    f.write(OFFSET.pack(size) + entries)
+                os.replace(f"{path}.tmp", path)
+        except FileNotFoundError:
+            pass  # built by the first reader
+        except (OSError, struct.error) as e:
+            logger.warning("Failed to update message offsets of %s: %s", self.path, e)
+
+
+class SavedHistory(msgspec.Struct, dict=True):
+    """Conversation persisted as an append-only log
+
+    The first record holds the id and model, every other one a message.
+    ``save()`` only appends the messages added since the previous save. When
+    already saved messages were dropped or replaced (e.g. a retry) a
+    truncation record is appended first, and the log is compacted once dead
+    records outnumber live ones.
+
+    Logs are written as JSON lines or length-prefixed MessagePack, chosen
+    by ``SavedHistory.format``. Loading detects the format of the file, and
+    the next compaction moves a history to the current format. Histories
+    packed away by ``SavedHistory.archive`` load the same way.
+    """
+
+    model: ModelType
+    messages: list[Message] = []
+    id: str = msgspec.field(default_factory=lambda: str(uuid4()))
+
+    # Format new logs are written in, a key of LOG_FORMATS
+    format: ClassVar[str] = "json"
+    # Metadata index updated by every save, None disables it
+    index: ClassVar[HistoryIndex | None] = HistoryIndex(os.path.join(SAVE_DIR, "index.sqlite3"))
+    # Compressed segments of cold histories, searched by load() after the live files
+    archive: ClassVar[HistoryArchive | None] = HistoryArchive(os.path.join(SAVE_DIR, "archive"))
+
+    def __post_init__(self) -> None:
+        self._format = LOG_FORMATS[SavedHistory.format]  # format of the log on disk
+        self._persisted: list[Message] = []  # messages already in the log
+        self._records = 0  # message and truncation records in the log
+
+    @property
+    def path(self) -> str:
+        return self._path(self._format)
+
+    def _path(self, fmt: LogFormat) -> str:
+        return os.path.join(SAVE_DIR, f"history_{self.id}{fmt.suffix}")
+
+    @property
+    def preview(self) -> str:
+        """Beginning of the first prompt"""
+        for message in self.messages:
+            if message.role == Role.user:
+                return message.content[:100]
+        return ""
 
     def add_input(self, message: str) -> None:
         self.messages.append(Message(Role.user, message))
@@ -51,34 +350,165 @@ class SavedHistory:
         self.messages.append(Message(Role.assistant, message))
 
     def save(self) -> None:
-        """Save the current conversation history to a file."""
-        # Ensure that the savedhistory directory exists
-        save_dir = os.path.join(os.path.dirname(__file__), '..', '..', 'savedhistory')
-        if not os.path.exists(save_dir):
-            os.makedirs(save_dir)
+        """Append the messages added since the last save to the log"""
+        pending = self.prepare_save()
+        if pending is None:
+            return
+        try:
+            pending.write()
+        except OSError:
+            self.save_failed()
+            if not pending.append:
+                raise
+            # The log vanished or could not be appended to, write it whole
+            self.compact()
+
+    def compact(self) -> None:
+        """Rewrite the log with only the live messages"""
+        self._prepare_compact().write()
+
+    def prepare_save(self) -> 'PendingWrite | None':
+        """Encode what the next save has to write and mark it as persisted
+
+        Only touches memory, so it can run on the event loop while
+        ``PendingWrite.write()`` does the disk I/O somewhere else.
+        """
+        persisted = self._persisted
+        if not persisted or self._format is not LOG_FORMATS[SavedHistory.format]:
+            return self._prepare_compact()
+
+        encode = self._format.encode
+        truncate = b""
+        # Saved messages may have been dropped or replaced anywhere, keep the common prefix
+        keep = 0
+        for old, new in zip(persisted, self.messages, strict=False):
+            if old is not new and old != new:
+                break
+            keep += 1
+        if keep < len(persisted):
+            truncate = encode(LogRecord(truncate=keep))
+            del persisted[keep:]
+        first_position = len(persisted)
+        new_messages = self.messages[first_position:]
+        records = [encode(message) for message in new_messages]
+        if not records and not truncate:
+            return None
 
-        file_path = os.path.join(save_dir, f"history_{self.id}.json")
-        with open(file_path, 'w') as f:
-            json.dump(self.to_dict(), f, indent=4)
+        added = len(records) + bool(truncate)
+        if self._records + added - len(self.messages) > max(len(self.messages), 16):
+            return self._prepare_compact()
+
+        persisted.extend(new_messages)
+        self._records += added
+        return PendingWrite(
+            self.path,
+            truncate + b"".join(records),
+            append=True,
+            offsets=record_offsets(records, len(truncate)),
+            **self._index_fields(first_position, new_messages),
+        )
+
+    def save_failed(self) -> None:
+        """Forget what is on disk after a failed write, the next save rewrites the log"""
+        self._persisted = []
+        self._records = 0
+
+    def _prepare_compact(self) -> 'PendingWrite':
+        old_format = self._format
+        self._format = fmt = LOG_FORMATS[SavedHistory.format]
+        data, offsets = self._encode_log()
+        self._persisted = list(self.messages)
+        self._records = len(self.messages)
+        # The log replaces the pre-log full JSON file and a log in another format
+        obsolete = [os.path.join(SAVE_DIR, f"history_{self.id}.json")]
+        if old_format is not fmt:
+            obsolete.append(self._path(old_format))
+        return PendingWrite(
+            self.path,
+            data,
+            append=False,
+            offsets=offsets,
+            obsolete=obsolete,
+            **self._index_fields(0, self.messages),
+        )
+
+    def _index_fields(self, first_position: int, messages: list[Message]) -> dict:
+        return {
+            "history_id": self.id,
+            "model": self.model.name,
+            "message_count": len(self.messages),
+            "preview": self.preview,
+            "first_position": first_position,
+            "messages": [(message.role.value, message.content) for message in messages],
+        }
 
     @staticmethod
     def load(history_id: str) -> 'SavedHistory':
-        """Load a conversation history from a file."""
-        # Ensure to load the file from the savedhistory directory
-        save_dir = os.path.join(os.path.dirname(__file__), '..', '..', 'savedhistory')
-        file_path = os.path.join(save_dir, f"history_{history_id}.json")
-        
+        """Load a conversation history by replaying its log, wherever it is stored."""
+        # Both logs only exist if a format change was interrupted, the newer one wins
+        paths = [os.path.join(SAVE_DIR, f"history_{history_id}{fmt.suffix}") for fmt in LOG_FORMATS.values()]
+        paths = [path for path in paths if os.path.exists(path)]
+        if paths:
+            with open(max(paths, key=os.path.getmtime), 'rb') as f:
+                return SavedHistory.from_log(f.read(), history_id)
+        if SavedHistory.archive is not None and not os.path.exists(
+            os.path.join(SAVE_DIR, f"history_{history_id}.json")
+        ):
+            data = SavedHistory.archive.read(history_id)
+            if data is not None:
+                saved_history = SavedHistory.from_log(data, history_id)
+                # There is no live log to append to, the next save writes one
+                saved_history.save_failed()
+                return saved_history
+        return SavedHistory._load_legacy(history_id)
+
+    @staticmethod
+    def from_log(data: bytes, history_id: str) -> 'SavedHistory':
+        """Replay the records of a log in any format"""
+        if not data:
+            raise DuckChatException(f"Empty history file for ID {history_id}")
+
+        fmt = sniff_format(data)
+        records, torn = fmt.decode(data)
+        if not records:
+            raise DuckChatException(f"Unreadable history file for ID {history_id}")
+
+        header = records[0]
+        messages: list[Message] = []
+        for record in records[1:]:
+            if record.truncate is not None:
+                del messages[record.truncate:]
+            else:
+                messages.append(Message(record.role, record.content))
+
+        saved_history = SavedHistory(model=header.model, messages=messages, id=header.id)
+        saved_history._format = fmt
+        # A torn log is rewritten on the next save instead of appended to
+        saved_history._persisted = [] if torn else list(messages)
+        saved_history._records = len(records) - 1
+        return saved_history
+
+    def to_log(self) -> bytes:
+        """The whole conversation as a compacted log in the current format"""
+        return self._encode_log()[0]
+
+    def _encode_log(self) -> tuple[bytes, list[int]]:
+        fmt = LOG_FORMATS[SavedHistory.format]
+        header = fmt.encode(LogRecord(id=self.id, model=self.model))
+        records = [fmt.encode(message) for message in self.messages]
+        return header + b"".join(records), record_offsets(records, len(header))
+
+    @staticmethod
+    def _load_legacy(history_id: str) -> 'SavedHistory':
+        """Load a history saved as one JSON document by older versions."""
+        file_path = os.path.join(SAVE_DIR, f"history_{history_id}.json")
+
         if not os.path.exists(file_path):
             raise DuckChatException(f"No history found for ID {history_id}")
-        
-        with open(file_path, 'r') as f:
-            history_data = json.load(f)
-        
-        return SavedHistory(
-            model=ModelType(history_data['model']),
-            messages=[Message(Role(msg['role']), msg['content']) for msg in history_data['messages']],
-            history_id=history_data['id']
-        )
+
+        with open(file_path, 'rb') as f:
+            # The document has the fields of the struct: id, model and messages
+            return msgspec.json.decode(f.read(), type=SavedHistory)
 
     def to_dict(self):
         return {
@@ -86,3 +516,16 @@ class SavedHistory:
             "model": self.model.value,
             "messages": [message.to_dict() for message in self.messages]
         }
+
+
+@contextlib.contextmanager
+def scratch_histories() -> Iterator[None]:
+    """Save histories to a temporary directory, off the real index, e.g. for load tests and batches"""
+    global SAVE_DIR
+    save_dir, index = SAVE_DIR, SavedHistory.index
+    with tempfile.TemporaryDirectory() as directory:
+        SAVE_DIR, SavedHistory.index = directory, None
+        try:
+            yield
+        finally:
+            SAVE_DIR, SavedHistory.index = save_dir, index
@@ -0,0 +1,146 @@
+import logging
+import mmap
+import os
+import struct
+
+import msgspec
+
+from . import models
+from .models import LOG_FORMATS, OFFSET, Message, SavedHistory, offsets_path, sniff_format
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryPager:
+    """Windowed reader of a saved history
+
+    Looks messages up in the per-conversation offset index (``.idx``, the
+    log size it covers then 8 bytes per message) and decodes only the
+    records of the requested window, optionally through ``mmap``. Reading
+    the last page of a 10k message conversation costs the same as for a
+    short one. A missing or stale index is rebuilt from the log once.
+
+    Files are only open during a call, so saves and compactions of the
+    conversation can go on in between. Archived and legacy histories have
+    no log to index and are loaded whole on first use.
+    """
+
+    def __init__(self, history_id: str, use_mmap: bool = True) -> None:
+        self.history_id = history_id
+        self.use_mmap = use_mmap
+        self._messages: list[Message] | None = None  # histories without a live log
+
+    def __len__(self) -> int:
+        path = self._log_path()
+        if path is None:
+            return len(self._loaded())
+        with open(path, 'rb') as log:
+            return self._read_offsets(log, path, 0, 0)[0]
+
+    def tail(self, count: int) -> tuple[int, list[Message]]:
+        """Position of the first of the last count messages, and those messages"""
+        path = self._log_path()
+        if path is None:
+            messages = self._loaded()
+            start = max(len(messages) - count, 0)
+            return start, messages[start:]
+        with open(path, 'rb') as log:
+            total = self._read_offsets(log, path, 0, 0)[0]
+            start = max(total - count, 0)
+            return start, self._read(log, path, start, total)
+
+    def page(self, start: int, stop: int) -> list[Message]:
+        """Messages start to stop, clipped to the conversation"""
+        path = self._log_path()
+        if path is None:
+            return self._loaded()[max(start, 0):stop]
+        with open(path, 'rb') as log:
+            return self._read(log, path, max(start, 0), stop)
+
+    def _read(self, log, path: str, start: int, stop: int) -> list[Message]:
+        for attempt in range(2):
+            count, offsets, size = self._read_offsets(log, path, start, stop, rebuild=attempt > 0)
+            stop = min(stop, count)
+            if start >= stop:
+                return []
+            # One read (or mapped slice) from the first record of the window to the end of the last
+            end = offsets[stop - start] if stop < count else size
+            first = offsets[0]
+            if not first <= end <= size:
+                logger.warning("Rebuilding message offsets of %s: offsets out of range", path)
+                continue
+            if self.use_mmap:
+                with mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    data = mapped[first:end]
+            else:
+                log.seek(first)
+                data = log.read(end - first)
+            fmt = sniff_format(self._first_byte(log))
+            try:
+                records = [fmt.decode_at(data, offset - first) for offset in offsets[:stop - start]]
+            except (msgspec.DecodeError, struct.error, ValueError) as e:
+                # The index was being rewritten by a save, or is damaged
+                logger.warning("Rebuilding message offsets of %s: %s", path, e)
+                continue
+            return [Message(record.role, record.content) for record in records]
+        return []
+
+    def _read_offsets(self, log, path: str, start: int, stop: int, rebuild: bool = False) -> tuple[int, list[int], int]:
+        """Message count, offsets of messages start to stop plus the one after, and log size"""
+        size = os.fstat(log.fileno()).st_size
+        index_path = offsets_path(path)
+        if not rebuild:
+            try:
+                with open(index_path, 'rb') as f:
+                    covered, = OFFSET.unpack(f.read(OFFSET.size))
+                    if covered == size:
+                        count = (os.fstat(f.fileno()).st_size - OFFSET.size) // OFFSET.size
+                        first = min(start, count)
+                        last = min(stop + 1, count)
+                        f.seek(OFFSET.size * (1 + first))
+                        data = f.read(OFFSET.size * (last - first))
+                        return count, list(struct.unpack(f"<{len(data) // OFFSET.size}Q", data)), size
+            except (OSError, struct.error):
+                pass
+        offsets = self._rebuild(log, index_path, size)
+        return len(offsets), offsets[start:stop + 1], size
+
+    def _rebuild(self, log, index_path: str, size: int) -> list[int]:
+        """Scan the whole log once for the offset of every live message"""
+        log.seek(0)
+        data = log.read(size)
+        fmt = sniff_format(data)
+        offsets: list[int] = []
+        for offset in fmt.offsets(data)[1:]:
+            try:
+                record = fmt.decode_at(data, offset)
+            except msgspec.DecodeError:
+                break  # torn last write
+            if record.truncate is not None:
+                del offsets[record.truncate:]
+            else:
+                offsets.append(offset)
+        try:
+            with open(f"{index_path}.tmp", 'wb') as f:
+                f.write(OFFSET.pack(size) + struct.pack(f"<{len(offsets)}Q", *offsets))
+            os.replace(f"{index_path}.tmp", index_path)
+        except OSError as e:
+            logger.warning("Failed to write message offsets %s: %s", index_path, e)
+        return offsets
+
+    @staticmethod
+    def _first_byte(log) -> bytes:
+        log.seek(0)
+        return log.read(1)
+
+    def _log_path(self) -> str | None:
+        paths = [
+            os.path.join(models.SAVE_DIR, f"history_{self.history_id}{fmt.suffix}") for fmt in LOG_FORMATS.values()
+        ]
+        paths = [path for path in paths if os.path.exists(path)]
+        return max(paths, key=os.path.getmtime) if paths else None
+
+    def _loaded(self) -> list[Message]:
+        if self._messages is None:
+            self._messages = SavedHistory.load(self.history_id).messages
+        return self._messages
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Self
+
+from .models import SavedHistory
+from .models.models import PendingWrite
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryWriter:
+    """Write-behind persistence of saved histories
+
+    ``mark_dirty()`` only records that a conversation changed. Dirty
+    conversations are coalesced and flushed in one batch every
+    ``flush_every`` turns and/or ``flush_interval`` seconds (both None means
+    only on ``flush()``/``close()``). Records are encoded on the event loop
+    and written by a single background thread, so writes of one
+    conversation land in order and disk I/O never blocks the loop.
+    """
+
+    def __init__(self, flush_every: int | None = None, flush_interval: float | None = 0.5) -> None:
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+
+        self.flushes = 0
+        self.writes = 0
+
+        self._dirty: dict[str, SavedHistory] = {}
+        self._turns = 0
+        self._timer: asyncio.TimerHandle | None = None
+        self._flushing: asyncio.Task[None] | None = None
+        self._flush_again = False
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="duck_chat-writer")
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.close()
+
+    def mark_dirty(self, history: SavedHistory) -> None:
+        """Schedule history to be written with the next flush"""
+        self._dirty[history.id] = history
+        self._turns += 1
+        if self.flush_every is not None and self._turns >= self.flush_every:
+            self._start_flush()
+        elif self.flush_interval is not None and self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self._start_flush)
+
+    async def flush(self) -> None:
+        """Write every dirty history and wait until it is on disk"""
+        # A failed append comes back dirty and is retried once as a full rewrite
+        for _ in range(2):
+            # Let a flush already in the worker thread finish first, batches stay ordered
+            while self._flushing is not None:
+                await asyncio.shield(self._flushing)
+            if not self._dirty:
+                return
+            self._start_flush()
+        while self._flushing is not None:
+            await asyncio.shield(self._flushing)
+
+    async def close(self) -> None:
+        """Flush what is left and stop the writer thread"""
+        await self.flush()
+        self._executor.shutdown(wait=True)
+
+    def _start_flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flushing is not None:
+            # Still writing, the batch after it picks up everything dirty by then
+            self._flush_again = True
+            return
+        self._turns = 0
+        batch = []
+        for history in self._dirty.values():
+            pending = history.prepare_save()
+            if pending is not None:
+                batch.append((history, pending))
+        self._dirty.clear()
+        if batch:
+            self._flushing = asyncio.get_running_loop().create_task(self._write(batch))
+
+    async def _write(self, batch: list[tuple[SavedHistory, PendingWrite]]) -> None:
+        try:
+            failed = await asyncio.get_running_loop().run_in_executor(self._executor, self._write_batch, batch)
+        except BaseException:
+            failed = [history for history, _ in batch]
+            raise
+        finally:
+            self._flushing = None
+            self.flushes += 1
+            self.writes += len(batch) - len(failed)
+            for history in failed:
+                # The next flush rewrites the whole log
+                history.save_failed()
+                self._dirty[history.id] = history
+            if self._flush_again and self._dirty:
+                self._flush_again = False
+                self._start_flush()
+
+    @staticmethod
+    def _write_batch(batch: list[tuple[SavedHistory, PendingWrite]]) -> list[SavedHistory]:
+        failed = []
+        for history, pending in batch:
+            try:
+                pending.write()
+            except OSError as e:
+                logger.error("Failed to save history %s: %s", history.id, e)
+                failed.append(history)
+        return failed
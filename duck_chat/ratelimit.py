@@ -0,0 +1,135 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from enum import IntEnum
+
+
+class Priority(IntEnum):
+    """Request classes, lower value is served first"""
+
+    interactive = 0  # a person is waiting for the answer (CLI, GUI)
+    batch = 1  # queued background work
+
+
+class RateLimiter:
+    """Token bucket that paces /status and /chat requests before they are sent
+
+    The refill rate follows AIMD: every successful request adds ``increase``
+    requests/s, every 429 or conversation limit multiplies the rate by
+    ``decrease``. Under sustained load this settles just below the server
+    limit. When tokens run out, waiting interactive requests are served
+    before waiting batch requests.
+    """
+
+    def __init__(
+        self,
+        rate: float = 2.0,
+        burst: int = 4,
+        min_rate: float = 0.2,
+        max_rate: float = 10.0,
+        increase: float = 0.05,
+        decrease: float = 0.5,
+        retries: int = 3,
+        backoff_base: float = 1.0,
+        backoff_max: float = 30.0,
+    ) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.retries = retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.throttled = 0  # number of 429 / conversation limit answers seen
+
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._waiters: list[tuple[int, int, asyncio.Future[None]]] = []
+        self._counter = itertools.count()
+        self._timer: asyncio.TimerHandle | None = None
+        self._loop: asyncio.AbstractEventLoop | None = None
+
+    async def acquire(self, priority: Priority = Priority.interactive) -> None:
+        """Wait for a token"""
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # Waiters of a previous event loop can never be woken up
+            self._loop = loop
+            self._waiters.clear()
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+
+        self._refill()
+        if not self._waiters and self._tokens >= 1:
+            self._tokens -= 1
+            return
+
+        waiter = loop.create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), waiter))
+        self._schedule()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # Token was granted right before cancellation, give it back
+                self._tokens += 1
+                self._wake()
+            raise
+
+    def on_success(self) -> None:
+        """Additive increase after a request went through"""
+        self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self) -> None:
+        """Multiplicative decrease after the server pushed back"""
+        self.throttled += 1
+        self._refill()
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self._tokens = min(self._tokens, 0.0)
+
+    def backoff(self, attempt: int) -> float:
+        """Jittered exponential delay before retry number ``attempt``"""
+        delay = min(self.backoff_max, self.backoff_base * 2**attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(float(self.burst), self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _schedule(self) -> None:
+        if self._timer is not None or not self._waiters or self._loop is None:
+            return
+        delay = max(0.0, (1 - self._tokens) / self.rate)
+        self._timer = self._loop.call_later(delay, self._wake)
+
+    def _wake(self) -> None:
+        self._timer = None
+        self._refill()
+        while self._waiters and self._tokens >= 1:
+            _, _, waiter = heapq.heappop(self._waiters)
+            if waiter.done():
+                continue
+            self._tokens -= 1
+            waiter.set_result(None)
+        # Drop cancelled waiters so they do not keep the timer alive
+        while self._waiters and self._waiters[0][2].done():
+            heapq.heappop(self._waiters)
+        self._schedule()
+
+
+_default_limiter: RateLimiter | None = None
+
+
+def get_default_limiter() -> RateLimiter:
+    """Process-wide rate limiter"""
+    global _default_limiter
+    if _default_limiter is None:
+        _default_limiter = RateLimiter()
+    return _default_limiter
@@ -0,0 +1,106 @@
+import asyncio
+from typing import AsyncGenerator, AsyncIterator, Callable
+
+from .exceptions import DuckChatException
+
+
+class Flight:
+    """One upstream answer, broadcast to every request waiting for it
+
+    Chunks are kept for the lifetime of the flight, a subscriber joining
+    late gets the prefix replayed before the live chunks.
+    """
+
+    def __init__(self) -> None:
+        self.chunks: list[str] = []
+        self.done = False
+        self.error: BaseException | None = None
+        self.subscribers = 0
+        self.abandoned = False  # every subscriber left, the upstream request is being cancelled
+        self.task: asyncio.Task[None] | None = None
+        self._more: asyncio.Future[None] | None = None
+
+    def publish(self, chunk: str) -> None:
+        self.chunks.append(chunk)
+        self._wake()
+
+    def finish(self, error: BaseException | None = None) -> None:
+        self.done = True
+        self.error = error
+        self._wake()
+
+    def _wake(self) -> None:
+        if self._more is not None:
+            self._more.set_result(None)
+            self._more = None
+
+    async def subscribe(self) -> AsyncGenerator[str, None]:
+        """Every chunk of the answer from the first one, raises the error of the upstream request"""
+        self.subscribers += 1
+        try:
+            index = 0
+            while True:
+                while index < len(self.chunks):
+                    yield self.chunks[index]
+                    index += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                if self._more is None:
+                    self._more = asyncio.get_running_loop().create_future()
+                # Shielded: a subscriber going away must not cancel the wait of the others
+                await asyncio.shield(self._more)
+        finally:
+            self.subscribers -= 1
+            if not self.subscribers and not self.done and self.task is not None:
+                self.abandoned = True
+                self.task.cancel()
+
+
+class SingleFlight:
+    """Share one upstream /chat request between identical requests in flight at the same time
+
+    Requests are keyed by their encoded /chat payload, which holds the
+    model and the full history. The first one (the leader) sends the
+    request from its DuckChat, the others subscribe to its answer instead of
+    sending their own. Once the answer is complete the key is free again,
+    later requests go upstream (see ResponseCache to reuse finished answers).
+    The upstream request is cancelled when every subscriber went away.
+    """
+
+    def __init__(self) -> None:
+        self.leaders = 0
+        self.coalesced = 0  # requests answered by the request of a leader
+
+        self._flights: dict[bytes, Flight] = {}
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._flights)
+
+    def join(self, key: bytes, start: Callable[[], AsyncIterator[str]]) -> tuple[Flight, bool]:
+        """Flight of key, and whether it was started by this call with the chunks of start()"""
+        flight = self._flights.get(key)
+        if flight is not None and not flight.abandoned:
+            self.coalesced += 1
+            return flight, False
+        flight = self._flights[key] = Flight()
+        flight.task = asyncio.create_task(self._run(key, flight, start()))
+        self.leaders += 1
+        return flight, True
+
+    async def _run(self, key: bytes, flight: Flight, chunks: AsyncIterator[str]) -> None:
+        try:
+            async for chunk in chunks:
+                flight.publish(chunk)
+        except asyncio.CancelledError:
+            flight.finish(DuckChatException("The shared request was cancelled"))
+            raise
+        except Exception as e:
+            flight.finish(e)
+        else:
+            flight.finish()
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
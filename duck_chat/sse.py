@@ -0,0 +1,104 @@
+from typing import Any
+
+import msgspec
+
+from .exceptions import (
+    ConversationLimitException,
+    DuckChatException,
+    RatelimitException,
+)
+
+DONE = b"[DONE]"
+LIMIT_CONVERSATION = b"[LIMIT_CONVERSATION]"
+# SSE fields besides data, ignored like blank lines and ":" comments
+IGNORED_FIELDS = (b"event:", b"id:", b"retry:")
+
+
+def raise_for_event(event: dict[str, Any]) -> None:
+    """Raise the matching exception if event is an error event"""
+    if event.get("action") != "error":
+        return
+    err_message = event.get("type", "") or str(event)
+    if event.get("status") == 429:
+        if err_message == "ERR_CONVERSATION_LIMIT":
+            raise ConversationLimitException(err_message)
+        raise RatelimitException(err_message)
+    raise DuckChatException(err_message)
+
+
+class SSEParser:
+    """Incremental parser for the /chat Server-Sent Events stream
+
+    Network chunks are appended to one reusable buffer and every complete
+    ``data:`` line is decoded in place through a memoryview, so each byte is
+    scanned once and only the trailing incomplete line is kept between feeds.
+    Each data line carries one JSON event. The ``[DONE]`` and
+    ``[LIMIT_CONVERSATION]`` markers set ``done`` and ``limit_reached``, error
+    events raise the matching DuckChatException. So do lines that are not
+    SSE, e.g. an HTML error page, and a stream that ends without any data.
+    """
+
+    def __init__(self, decoder: msgspec.json.Decoder | None = None) -> None:
+        self._decoder = decoder or msgspec.json.Decoder()
+        self._buffer = bytearray()
+        self.done = False
+        self.limit_reached = False
+        self.size = 0  # total bytes fed
+        self.data_lines = 0
+
+    def feed(self, chunk: bytes) -> list[dict[str, Any]]:
+        """Parse a network chunk, return the events it completed"""
+        buffer = self._buffer
+        # The kept tail never contains a newline, only search the new bytes
+        search_from = len(buffer)
+        buffer += chunk
+        self.size += len(chunk)
+
+        events: list[dict[str, Any]] = []
+        start = 0
+        with memoryview(buffer) as view:
+            while (end := buffer.find(b"\n", search_from)) != -1:
+                self._parse_line(view[start:end], events)
+                start = search_from = end + 1
+        if start:
+            del buffer[:start]
+        return events
+
+    def close(self) -> list[dict[str, Any]]:
+        """Parse what is left when the stream ends without a final newline"""
+        events: list[dict[str, Any]] = []
+        if self._buffer:
+            with memoryview(self._buffer) as view:
+                self._parse_line(view, events)
+            self._buffer.clear()
+        if not self.data_lines:
+            raise DuckChatException("No data in the answer" if self.size else "Empty body")
+        return events
+
+    def _parse_line(self, line: memoryview, events: list[dict[str, Any]]) -> None:
+        if line[-1:] == b"\r":
+            line = line[:-1]
+        if line[:5] == b"data:":
+            data = line[6:] if line[5:6] == b" " else line[5:]
+        elif line[:1] == b"{":
+            # Bare JSON body, e.g. an error answered without SSE framing
+            data = line
+        elif not line or line[:1] == b":" or line[:6].tobytes().startswith(IGNORED_FIELDS):
+            return
+        else:
+            raise DuckChatException(f"Couldn't parse body={bytes(line[:500]).decode(errors='replace')}")
+
+        self.data_lines += 1
+        if data == DONE:
+            self.done = True
+            return
+        if data == LIMIT_CONVERSATION:
+            self.limit_reached = True
+            return
+        try:
+            event = self._decoder.decode(data)
+        except msgspec.DecodeError:
+            raise DuckChatException(f"Couldn't parse body={bytes(data).decode(errors='replace')}")
+        if isinstance(event, dict):
+            raise_for_event(event)
+            events.append(event)
@@ -0,0 +1,92 @@
+import time
+from types import SimpleNamespace
+from typing import Any, Callable
+
+import aiohttp
+import msgspec
+
+
+class TraceEvent(msgspec.Struct):
+    """One timestamped step of a request"""
+
+    name: str
+    time: float  # time.perf_counter()
+    data: dict[str, Any] = {}
+
+
+TraceHook = Callable[[TraceEvent], None]
+
+
+class Tracer:
+    """Send request timing events to subscribed hooks
+
+    Events emitted by DuckChat, in request order:
+
+    - ``vqd_fetch_start`` / ``vqd_fetch_end`` (``prefetched``)
+    - ``connection_acquire_start`` / ``connection_acquire_end`` (``reused``)
+    - ``request_sent`` (``method``, ``url``)
+    - ``response_headers`` (``status``)
+    - ``first_byte``
+    - ``first_token``
+    - ``chunk`` (``size``) for every network chunk
+    - ``complete`` (``chars``)
+
+    A tracer without hooks is falsy and DuckChat checks it before building
+    any event, so tracing costs nothing until something subscribes.
+    """
+
+    def __init__(self) -> None:
+        self._hooks: list[TraceHook] = []
+        self._trace_config: aiohttp.TraceConfig | None = None
+
+    def __bool__(self) -> bool:
+        return bool(self._hooks)
+
+    def subscribe(self, hook: TraceHook) -> None:
+        self._hooks.append(hook)
+
+    def unsubscribe(self, hook: TraceHook) -> None:
+        self._hooks.remove(hook)
+
+    def emit(self, name: str, **data: Any) -> None:
+        event = TraceEvent(name, time.perf_counter(), data)
+        for hook in self._hooks:
+            hook(event)
+
+    @property
+    def trace_config(self) -> aiohttp.TraceConfig:
+        """aiohttp trace config reporting connection and request steps"""
+        if self._trace_config is None:
+            config = aiohttp.TraceConfig()
+            config.on_request_start.append(self._on_acquire_start)
+            config.on_connection_create_end.append(self._on_created)
+            config.on_connection_reuseconn.append(self._on_reused)
+            config.on_request_headers_sent.append(self._on_request_sent)
+            config.on_request_end.append(self._on_response_headers)
+            config.freeze()
+            self._trace_config = config
+        return self._trace_config
+
+    async def _on_acquire_start(self, session: aiohttp.ClientSession, ctx: SimpleNamespace, params: Any) -> None:
+        if self._hooks:
+            self.emit("connection_acquire_start")
+
+    async def _on_created(self, session: aiohttp.ClientSession, ctx: SimpleNamespace, params: Any) -> None:
+        if self._hooks:
+            self.emit("connection_acquire_end", reused=False)
+
+    async def _on_reused(self, session: aiohttp.ClientSession, ctx: SimpleNamespace, params: Any) -> None:
+        if self._hooks:
+            self.emit("connection_acquire_end", reused=True)
+
+    async def _on_request_sent(
+        self, session: aiohttp.ClientSession, ctx: SimpleNamespace, params: aiohttp.TraceRequestHeadersSentParams
+    ) -> None:
+        if self._hooks:
+            self.emit("request_sent", method=params.method, url=str(params.url))
+
+    async def _on_response_headers(
+        self, session: aiohttp.ClientSession, ctx: SimpleNamespace, params: aiohttp.TraceRequestEndParams
+    ) -> None:
+        if self._hooks:
+            self.emit("response_headers", status=params.response.status)
@@ -0,0 +1,127 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Self
+
+import aiohttp
+
+from .api import DuckChat
+from .connection import ConnectionPool
+from .ratelimit import Priority, RateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+class VqdPrefetcher:
+    """Keep a small stock of fresh x-vqd-4 tokens in the background
+
+    A DuckChat created with ``prefetcher=`` takes its first token from the
+    stock instead of waiting for a /status round-trip. Tokens older than
+    ``ttl`` seconds are thrown away and replaced.
+    """
+
+    def __init__(
+        self,
+        size: int = 4,
+        ttl: float = 120.0,
+        pool: ConnectionPool | None = None,
+        rate_limiter: RateLimiter | None = None,
+        retry_delay: float = 5.0,
+        **chat_kwargs: Any,
+    ) -> None:
+        self.size = size
+        self.ttl = ttl
+        self.retry_delay = retry_delay
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+
+        self._pool = pool
+        self._rate_limiter = rate_limiter
+        self._chat_kwargs = chat_kwargs
+        self._chat: DuckChat | None = None
+        self._stock: deque[tuple[str, float]] = deque()
+        self._wanted = asyncio.Event()
+        self._task: asyncio.Task[None] | None = None
+
+    async def __aenter__(self) -> Self:
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc_info: Any) -> None:
+        await self.stop()
+
+    def __len__(self) -> int:
+        return len(self._stock)
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def start(self) -> None:
+        """Start refilling the stock on the running event loop"""
+        if self._task is not None and not self._task.done():
+            return
+        # Refills are background work, they must not delay interactive requests
+        self._chat = DuckChat(
+            pool=self._pool,
+            rate_limiter=self._rate_limiter,
+            priority=Priority.batch,
+            **self._chat_kwargs,
+        )
+        self._wanted = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop refilling and drop the stock"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._chat is not None:
+            await self._chat.__aexit__()
+            self._chat = None
+        self._stock.clear()
+
+    def take(self) -> str | None:
+        """Get a fresh token from the stock, None if it is empty"""
+        self._drop_expired()
+        self._wanted.set()
+        if self._stock:
+            self.hits += 1
+            return self._stock.popleft()[0]
+        self.misses += 1
+        return None
+
+    def _drop_expired(self) -> None:
+        deadline = time.monotonic() - self.ttl
+        while self._stock and self._stock[0][1] < deadline:
+            self._stock.popleft()
+            self.expired += 1
+
+    async def _run(self) -> None:
+        assert self._chat is not None
+        while True:
+            self._drop_expired()
+            if len(self._stock) >= self.size:
+                # Sleep until a token is taken or the oldest one expires
+                self._wanted.clear()
+                timeout = self._stock[0][1] + self.ttl - time.monotonic()
+                try:
+                    await asyncio.wait_for(self._wanted.wait(), timeout=max(timeout, 0))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._chat.get_vqd()
+            except aiohttp.ClientError as e:
+                logger.warning("Failed to prefetch x-vqd-4 token: %s", e)
+                await asyncio.sleep(self.retry_delay)
+                continue
+            self._stock.append((self._chat.vqd.pop(), time.monotonic()))
@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Any, Callable, Coroutine, Self, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class LoopThread:
+    """Event loop running in one background thread for the lifetime of an app
+
+    Synchronous code (a GUI main loop) hands coroutines over with
+    ``submit()``, which returns a ``concurrent.futures.Future`` that can be
+    waited on, given done callbacks or cancelled. Coroutines submitted
+    together run concurrently on the same loop, so aiohttp sessions and
+    HistoryWriter timers created on it stay valid between requests.
+
+    Done callbacks run in the loop thread, marshal results back to your
+    UI thread yourself (e.g. with ``Clock.schedule_once``).
+    """
+
+    def __init__(self, name: str = "duck_chat-loop") -> None:
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._futures: set[Future[Any]] = set()
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> Self:
+        return self.start()
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.stop()
+
+    def start(self) -> Self:
+        self._thread.start()
+        return self
+
+    @property
+    def pending(self) -> int:
+        """Submitted coroutines not done yet"""
+        with self._lock:
+            return len(self._futures)
+
+    def submit(
+        self, coro: Coroutine[Any, Any, T], callback: Callable[[Future[T]], None] | None = None
+    ) -> Future[T]:
+        """Schedule coro on the loop, callback is called with the future once it is done"""
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._done)
+        if callback is not None:
+            future.add_done_callback(callback)
+        return future
+
+    def run(self, coro: Coroutine[Any, Any, T], timeout: float | None = None) -> T:
+        """Run coro on the loop and wait for its result"""
+        return self.submit(coro).result(timeout)
+
+    def cancel_all(self) -> int:
+        """Cancel every pending coroutine, return how many"""
+        with self._lock:
+            futures = list(self._futures)
+        return sum(future.cancel() for future in futures)
+
+    def stop(self, timeout: float | None = None) -> None:
+        """Cancel what is still pending, then stop and close the loop"""
+        if not self._thread.is_alive():
+            return
+        self.cancel_all()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+
+    def _done(self, future: Future[Any]) -> None:
+        with self._lock:
+            self._futures.discard(future)
+        if not future.cancelled() and future.exception() is not None:
+            logger.debug("Background task failed: %r", future.exception())
+
+    def _run(self) -> None:
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            # Let cancelled tasks unwind (close their sessions, flush their writers) before closing
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+            self.loop.close()